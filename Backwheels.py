@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 import os
-import sys
-import json
-import pathlib
 import logging
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-
-from PCA9685 import PWM
-from TB6612 import Motor
+from . import calibration
+from . import config
+from . import devices
+from .TB6612 import Motor
 
 
 class Backwheels(object):
@@ -25,9 +22,9 @@ class Backwheels(object):
         """ Init the direction channel and pwm channel """
         self.logger = logging.getLogger(__name__)
         try:
-            with open(os.path.join(os.getcwd(), db), 'r') as configFile:
-                jsondata = configFile.read()
-            self.db = json.loads(jsondata)
+            # shared with every other driver reading the same file
+            self.db = config.get_config(db)
+            self.db.require("forward_A", "forward_B")
 
             self.forward_A = self.db["forward_A"]
             self.forward_B = self.db["forward_B"]
@@ -35,16 +32,17 @@ class Backwheels(object):
             self.left_wheel = Motor(self.Motor_A, offset=self.forward_A)
             self.right_wheel = Motor(self.Motor_B, offset=self.forward_B)
 
-            self.pwm = PWM(bus_number=bus_number)
-            self.pwm.setup()
+            self.pwm = devices.get_pwm(bus_number=bus_number)
+
+            # Optional per motor curves: "dead_zone_A": 600, "gamma_A": 1.2 ...
+            self.left_table = calibration.motor_table(self.db.get("dead_zone_A", 0), self.db.get("gamma_A", 1.0))
+            self.right_table = calibration.motor_table(self.db.get("dead_zone_B", 0), self.db.get("gamma_B", 1.0))
 
             def _set_a_pwm(value):
-                pulse_wide = int(self.pwm.map(value, 0, 100, 0, 4095))
-                self.pwm.write(self.PWM_A, 0, pulse_wide)
+                self.pwm.write(self.PWM_A, 0, self.left_table.lookup(value))
 
             def _set_b_pwm(value):
-                pulse_wide = int(self.pwm.map(value, 0, 100, 0, 4095))
-                self.pwm.write(self.PWM_B, 0, pulse_wide)
+                self.pwm.write(self.PWM_B, 0, self.right_table.lookup(value))
 
             self.left_wheel.pwm = _set_a_pwm
             self.right_wheel.pwm = _set_b_pwm
@@ -57,6 +55,9 @@ class Backwheels(object):
             self.logger.info("CWD: %s" % os.getcwd())
             self.logger.exception("Can't open/read config pls. Please specify the path relative to your main.py file")
             raise Exception from e
+        except KeyError as e:
+            self.logger.exception("Config value missing")
+            raise Exception from e
         except ValueError as e:
             self.logger.exception("Json value error")
             raise Exception from e
@@ -65,51 +66,78 @@ class Backwheels(object):
         """ Move both wheels forward """
         if speed is not None:
             self.speed = speed
-        self.left_wheel.forward()
-        self.right_wheel.forward()
-        self.logger.info('Running forward')
+        with self.pwm.frame():
+            self.left_wheel.forward()
+            self.right_wheel.forward()
+        self.logger.debug('Running forward')
 
     def forwardLeft(self, speed=None):
         """ Move left wheel forward """
         if speed is not None:
             self.speed = speed
         self.left_wheel.forward()
-        self.logger.info('Left running forward')
+        self.logger.debug('Left running forward')
 
     def forwardRight(self, speed=None):
         """ Move right wheel forward """
         if speed is not None:
             self.speed = speed
         self.right_wheel.forward()
-        self.logger.info('Right running forward')
+        self.logger.debug('Right running forward')
 
     def backward(self, speed=None):
         """ Move both wheels backward """
         if speed is not None:
             self.speed = speed
-        self.left_wheel.backward()
-        self.right_wheel.backward()
-        self.logger.info('Running backward')
+        with self.pwm.frame():
+            self.left_wheel.backward()
+            self.right_wheel.backward()
+        self.logger.debug('Running backward')
 
     def backwardLeft(self, speed=None):
         """ Move left wheels backward """
         if speed is not None:
             self.speed = speed
         self.left_wheel.backward()
-        self.logger.info('Running backward left')
+        self.logger.debug('Running backward left')
 
     def backwardRight(self, speed=None):
         """ Move right wheels backward """
         if speed is not None:
             self.speed = speed
         self.right_wheel.backward()
-        self.logger.info('Running backward right')
+        self.logger.debug('Running backward right')
+
+    def drive(self, left, right):
+        """ Signed wheel speeds from -100 to 100 percent, negative drives backward
+
+            Only direction pins and duty cycles that change are written, and
+            both PWM channels go out together in one I2C transaction.
+        """
+        with self.pwm.frame():
+            self.left_wheel.drive(left)
+            self.right_wheel.drive(right)
+        self.logger.debug('Drive left %s right %s', left, right)
+
+    def steer(self, speed, left_scale=1.0, right_scale=1.0):
+        """ drive() at speed times left_scale and right_scale, see MotorController.steer() """
+        self.drive(speed * left_scale, speed * right_scale)
 
     def stop(self):
         """ Stop both wheels """
-        self.left_wheel.stop()
-        self.right_wheel.stop()
-        self.logger.info('Stop')
+        with self.pwm.frame():
+            self.left_wheel.stop()
+            self.right_wheel.stop()
+        self.logger.debug('Stop')
+
+    def emergency_stop(self):
+        """ Cut every PCA9685 output in one I2C transaction
+
+            Unlike stop() this also releases the head servo and leaves the
+            wheels' speed settings alone, the next speed write resumes them.
+        """
+        self.pwm.all_off()
+        self.logger.warning('Emergency stop')
     
     @property
     def speed(self, speed):
@@ -119,21 +147,22 @@ class Backwheels(object):
     def speed(self, speed):
         self._speed = speed
         """ Set moving speeds """
-        self.left_wheel.speed = self._speed
-        self.right_wheel.speed = self._speed
-        self.logger.info('Set speed to %s' % str(self._speed))
+        with self.pwm.frame():
+            self.left_wheel.speed = self._speed
+            self.right_wheel.speed = self._speed
+        self.logger.debug('Set speed to %s', self._speed)
 
     def speedLeft(self, speed):
         self._speed = speed
         """ Set moving speeds """
         self.left_wheel.speed = self._speed
-        self.logger.info('Set speed to %s' % str(self._speed))
+        self.logger.debug('Set speed to %s', self._speed)
 
     def speedRight(self, speed):
         self._speed = speed
         """ Set moving speeds """
         self.right_wheel.speed = self._speed
-        self.logger.info('Set speed to %s' % str(self._speed))
+        self.logger.debug('Set speed to %s', self._speed)
 
     def ready(self):
         """ Get the back wheels to the ready position. (stop) """
@@ -166,8 +195,9 @@ class Backwheels(object):
         """ Save the calibration value """
         self.forward_A = self.cali_forward_A
         self.forward_B = self.cali_forward_B
-        self.db.set('forward_A', self.forward_A)
-        self.db.set('forward_B', self.forward_B)
+        with self.db.batch():
+            self.db.set('forward_A', self.forward_A)
+            self.db.set('forward_B', self.forward_B)
         self.stop()
 
 
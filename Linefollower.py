@@ -1,105 +1,345 @@
 #!/usr/bin/env python3
 
 import logging
-import math
+import struct
 import time
+from concurrent.futures import TimeoutError as FutureTimeout
 
-# import smbus
-from smbus2 import SMBus
+try:
+    import numpy as np
+except ImportError:  # only read_batch() and the batch helpers need it
+    np = None
+
+from . import arbiter
+from . import devices
+from . import steering
+from . import thresholds
+from .sampler import LineFrame, LineSampler
+
+
+class LineTimeout(IOError):
+    """ No line sensor frame arrived before the deadline """
 
 
 class Linefollower(object):
-    def __init__(self, address=0x11, references=[170,170,170,170,170]):
+    # one frame: five big-endian 16-bit analog values
+    _FRAME = struct.Struct('>5H')
+    FRAME_SIZE = _FRAME.size
+    # pause between polls when waiting without a running sampler
+    POLL_INTERVAL = 0.002
+    # sensor positions for line_position(), left to right
+    _POSITIONS = (-1.0, -0.5, 0.0, 0.5, 1.0)
+    # assumed white to black distance while no calibration is known
+    ANALOG_SPAN = 100
+    # oldest frame read() hands out again when a fresh one cannot be read
+    STALE_LIMIT = 0.1
+
+    def __init__(self, address=0x11, references=[170,170,170,170,170], bus_number=1):
         self.logger = logging.getLogger(__name__)
-        self.bus = SMBus(1)
+        self.bus = devices.get_bus(bus_number, arbiter.PRIORITY_SENSOR)
         self.address = address
         self._references = references
+        self.sampler = None
+        self.tracker = None
+        self._last_frame = None
+        self._sequence = 0
+        self.reads = 0
+        self.attempts = 0
+        self.retries = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.stale_reads = 0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
 
-    def read_raw(self):
-        for i in range(0, 5):
+    def _transfer(self, timeout):
+        if timeout is None:
+            return self.bus.read_i2c_block_data(self.address, 0, 10)
+        future = self.bus.submit('read_i2c_block_data', self.address, 0, 10)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    def read_raw(self, trys=5, deadline=None):
+        """ One raw frame in at most trys attempts, False if none
+
+            deadline is a time.monotonic() value, no attempt is started or
+            waited on past it.
+        """
+        for attempt in range(trys):
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            self.attempts += 1
+            if attempt:
+                self.retries += 1
             try:
-                raw_result = self.bus.read_i2c_block_data(self.address, 0, 10)
-                Connection_OK = True
+                return self._transfer(timeout)
+            except FutureTimeout:
+                self.timeouts += 1
                 break
-            except:
-                Connection_OK = False
+            except IOError as e:
+                self.errors += 1
+                self.logger.debug('Reading %02X failed: %s', self.address, e)
+        # callers decide how loud a failed read is, the sampler may see 200/s
+        self.logger.debug('Error accessing %2X', self.address)
+        return False
+
+    @classmethod
+    def decode(cls, raw_result):
+        """ Five analog values of one raw 10 byte frame """
+        return cls._FRAME.unpack(bytes(raw_result))
+
+    @staticmethod
+    def decode_batch(raw_results, out=None):
+        """ (n, 5) uint16 array of n raw frames concatenated in one buffer
+
+            Decoded straight into out if given, without an intermediate array.
+        """
+        frames = np.frombuffer(raw_results, dtype='>u2').reshape(-1, 5)
+        if out is None:
+            return frames.astype(np.uint16)
+        out[:] = frames
+        return out
 
-        if Connection_OK:
+    def _read_frame(self, trys, deadline=None):
+        started = time.perf_counter()
+        raw_result = self.read_raw(trys, deadline)
+        latency = time.perf_counter() - started
+        self.reads += 1
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+        if raw_result:
             return raw_result
-        else:
-            self.logger.error('Error accessing %2X' % self.address)
-            return False
-
-    def read_analog(self, trys=5):
-        for _ in range(trys):
-            raw_result = self.read_raw()
-            if raw_result:
-                analog_result = [0, 0, 0, 0, 0]
-                for i in range(0, 5):
-                    high_byte = raw_result[i * 2] << 8
-                    low_byte = raw_result[i * 2 + 1]
-                    analog_result[i] = high_byte + low_byte
-                    if analog_result[i] > 1024:
-                        continue
-                return analog_result
-        else:
-            raise IOError("Line follower read error. Please check the wiring.")
+        self.failures += 1
+        if deadline is not None and time.monotonic() >= deadline:
+            raise LineTimeout("Line follower read timed out after %.1f ms" % (latency * 1000))
+        raise IOError("Line follower read error. Please check the wiring.")
+
+    def read_analog(self, trys=5, timeout=None):
+        """ Five analog values, raises IOError (LineTimeout after timeout seconds) """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return list(self.decode(self._read_frame(trys, deadline)))
+
+    def read(self, timeout=0.01, trys=3):
+        """ A fresh LineFrame within timeout seconds
+
+            If the sensor cannot be read in time the last good frame is
+            returned again with stale=True, as long as it is not older than
+            STALE_LIMIT. Returns None when there is no such frame.
+        """
+        try:
+            analog = self.read_analog(trys, timeout)
+        except IOError:
+            frame = self._last_frame
+            if frame is None or time.monotonic() - frame.timestamp > self.STALE_LIMIT:
+                return None
+            self.stale_reads += 1
+            return frame._replace(stale=True)
+        self._sequence += 1
+        self._last_frame = self.make_frame(analog, sequence=self._sequence)
+        return self._last_frame
+
+    def read_stats(self):
+        """ Retry counts, error rate and read latency (ms) so far """
+        return {'reads': self.reads,
+                'attempts': self.attempts,
+                'retries': self.retries,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'stale': self.stale_reads,
+                'error_rate': self.errors / self.attempts if self.attempts else 0.0,
+                'latency_avg_ms': self.latency_total / self.reads * 1000 if self.reads else 0.0,
+                'latency_max_ms': self.latency_max * 1000}
+
+    @staticmethod
+    def digitize(lt, references):
+        """ 0 for white (above reference), 1 for black, -1 when equal """
+        return [0 if value > reference else 1 if value < reference else -1
+                for value, reference in zip(lt, references)]
 
     def read_digital(self, references=None):
-        lt = self.read_analog()
-        digital_list = []
         if not references:
             references = self.references
-        for i in range(0, 5):
-            if lt[i] > references[i]:
-                digital_list.append(0)
-            elif lt[i] < references[i]:
-                digital_list.append(1)
+        return self.digitize(self.read_analog(), references)
+
+    encode = staticmethod(steering.encode)
+
+    def read_code(self):
+        """ Base-3 code (0..242) of one fresh digital reading """
+        return self.encode(self.read_digital())
+
+    def make_frame(self, analog, timestamp=None, sequence=0):
+        """ LineFrame of analog values, thresholded with the current references """
+        if self.tracker is not None:
+            references = self.tracker.update(analog)
+            if references is not None:
+                self._references = references
+        digital = self.digitize(analog, self.references)
+        return LineFrame(time.monotonic() if timestamp is None else timestamp,
+                         analog, digital, sequence, self.encode(digital))
+
+    def darkness(self, analog):
+        """ Analog values normalised to 0 (white) .. 1 (black)
+
+            Uses the tracker's white and black means once they pass its own
+            checks (see ReferenceTracker.means()), otherwise ANALOG_SPAN
+            centred on each reference.
+        """
+        tracker = self.tracker
+        levels = []
+        for i, value in enumerate(analog):
+            means = tracker.means(i) if tracker is not None else None
+            if means is not None:
+                white, black = means
             else:
-                digital_list.append(-1)
-        return digital_list
+                white = self.references[i] + self.ANALOG_SPAN / 2
+                black = self.references[i] - self.ANALOG_SPAN / 2
+            if white <= black:
+                levels.append(1.0 if value < self.references[i] else 0.0)
+            else:
+                levels.append(min(1.0, max(0.0, (white - value) / (white - black))))
+        return levels
+
+    def line_position(self, analog, min_darkness=0.5):
+        """ Line position from -1 (leftmost sensor) to 1 (rightmost sensor)
+
+            Weighted centroid of darkness(), so the line is located between
+            sensors too. Returns None when the sensors see less than
+            min_darkness in total, i.e. no line.
+        """
+        levels = self.darkness(analog)
+        total = sum(levels)
+        if total < min_darkness:
+            return None
+        return sum(level * position for level, position in zip(levels, self._POSITIONS)) / total
+
+    def read_batch(self, n, out=None, trys=5):
+        """ Sample n frames into a (n, 5) uint16 array, out is reused if given """
+        if np is None:
+            raise ImportError('Linefollower.read_batch() needs numpy')
+        if out is None:
+            out = np.empty((n, 5), dtype=np.uint16)
+        raw_results = bytearray(n * self.FRAME_SIZE)
+        for i in range(n):
+            raw_results[i * self.FRAME_SIZE:(i + 1) * self.FRAME_SIZE] = self._read_frame(trys)
+        return self.decode_batch(raw_results, out)
+
+    @staticmethod
+    def digitize_batch(batch, references):
+        """ digitize() over a whole (n, 5) batch, returns an int8 array """
+        references = np.asarray(references)
+        return np.where(batch > references, 0, np.where(batch < references, 1, -1)).astype(np.int8)
 
     def get_average(self, mount):
         if not isinstance(mount, int):
             raise ValueError("Mount must be integer")
-        average = [0, 0, 0, 0, 0]
-        lt_list = [[], [], [], [], []]
-        for times in range(0, mount):
-            lt = self.read_analog()
-            for lt_id in range(0, 5):
-                lt_list[lt_id].append(lt[lt_id])
-        for lt_id in range(0, 5):
-            average[lt_id] = int(math.fsum(lt_list[lt_id]) / mount)
-        return average
+        if np is not None:
+            return self.read_batch(mount).mean(axis=0).astype(int).tolist()
+        sums = [0, 0, 0, 0, 0]
+        for _ in range(mount):
+            sums = [total + value for total, value in zip(sums, self.read_analog())]
+        return [int(total / mount) for total in sums]
+
+    def start_sampler(self, rate=200):
+        """ Sample the sensor on a background thread, see LineSampler """
+        if self.sampler is None:
+            self.sampler = LineSampler(self, rate)
+        self.sampler.rate = rate
+        self.sampler.start()
+        return self.sampler
+
+    def stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def track_references(self, window=500, hysteresis=4, min_contrast=20, white=None, black=None):
+        """ Adapt the references to every frame read, see thresholds.ReferenceTracker
+
+            white and black are optional calibration averages to start from.
+        """
+        self.tracker = thresholds.ReferenceTracker(self.references, window, hysteresis, min_contrast)
+        if white is not None and black is not None:
+            self.tracker.seed(white, black)
+        return self.tracker
+
+    def stop_tracking(self):
+        self.tracker = None
+
+    def wait_for(self, predicate, timeout=None):
+        """ Wait until predicate(digital status) is true, returns the status or None on timeout
+
+            Blocks on the sampler's frames while it runs, otherwise polls
+            read_digital() every POLL_INTERVAL seconds.
+        """
+        if self.sampler is not None and self.sampler.running:
+            frame = self.sampler.wait_for(predicate, timeout)
+            return None if frame is None else frame.digital
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            lt_status = self.read_digital()
+            if predicate(lt_status):
+                return lt_status
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def next_frame(self, timeout=None):
+        """ Next new sampler LineFrame, or a direct read() without sampler
+
+            Returns None when neither a fresh nor a recent stale frame is
+            available within timeout.
+        """
+        if self.sampler is not None and self.sampler.running:
+            frame = self.sampler.wait_next(timeout)
+            if frame is not None:
+                return frame
+            frame = self.sampler.latest()
+            if frame is None or time.monotonic() - frame.timestamp > self.STALE_LIMIT:
+                return None
+            self.stale_reads += 1
+            return frame._replace(stale=True)
+        return self.read(self.STALE_LIMIT if timeout is None else timeout)
+
+    def latest_frame(self):
+        """ The sampler's newest LineFrame without waiting for a new one
+
+            None if it is older than STALE_LIMIT. Without a running sampler
+            this is a direct read().
+        """
+        if self.sampler is not None and self.sampler.running:
+            frame = self.sampler.latest()
+            if frame is None or time.monotonic() - frame.timestamp > self.STALE_LIMIT:
+                return None
+            return frame
+        return self.read()
+
+    def next_digital(self, timeout=None):
+        frame = self.next_frame(timeout)
+        return None if frame is None else frame.digital
 
     def found_line_in(self, timeout):
         if isinstance(timeout, int) or isinstance(timeout, float):
             pass
         else:
             raise ValueError("timeout must be integer or float")
-        time_start = time.time()
-        time_during = 0
-        while time_during < timeout:
-            lt_status = self.read_digital()
-            result = 0
-            if 1 in lt_status:
-                return lt_status
-            time_now = time.time()
-            time_during = time_now - time_start
-        return False
+        lt_status = self.wait_for(lambda status: 1 in status, timeout)
+        return lt_status if lt_status is not None else False
 
-    def wait_tile_status(self, status):
-        while True:
-            lt_status = self.read_digital()
-            if lt_status in status:
-                break
+    def wait_tile_status(self, status, timeout=None):
+        return self.wait_for(lambda lt_status: lt_status in status, timeout)
 
-    def wait_tile_center(self):
-        while True:
-            lt_status = self.read_digital()
-            if lt_status[2] == 1:
-                break
-        print("%d", lt_status[2])
+    def wait_tile_center(self, timeout=None):
+        lt_status = self.wait_for(lambda status: status[2] == 1, timeout)
+        self.logger.debug('Tile center: %s', lt_status)
+        return lt_status
 
     def cali(self, fw):
         references = [0, 0, 0, 0, 0]
@@ -143,6 +383,8 @@ class Linefollower(object):
     @references.setter
     def references(self, value):
         self._references = value
+        if self.tracker is not None:
+            self.tracker.references = list(value)
 
 
 if __name__ == '__main__':
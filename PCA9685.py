@@ -12,11 +12,15 @@
 """
 import logging
 import math
+import threading
 import time
 
 # import smbus
 from smbus2 import SMBus
 
+from .arbiter import PRIORITY_EMERGENCY
+from .health import BusHealth
+
 
 class PWM(object):
     """A PWM control class for PCA9685."""
@@ -36,49 +40,166 @@ class PWM(object):
     _ALL_LED_OFF_H = 0xFD
 
     _RESTART = 0x80
+    _AI = 0x20
     _SLEEP = 0x10
     _ALLCALL = 0x01
     _INVRT = 0x10
     _OUTDRV = 0x04
+    _FULL = 0x1000
+
+    # SMBus block transfers carry at most 32 data bytes, i.e. 8 LED channels
+    _BLOCK_MAX = 32
+    _CHANNELS = 16
+    # Registers whose writes have no side effect beyond storing the value,
+    # so a write of the value already held can be dropped
+    _CACHE_FIRST = _LED0_ON_L
+    _CACHE_LAST = _LED0_ON_L + 4 * _CHANNELS - 1
 
-    def __init__(self, bus_number=1, address=0x40):
+    def __init__(self, bus_number=1, address=0x40, bus=None, health=None):
         self.logger = logging.getLogger(__name__)
         self._frequency = 60
         self.address = address
         self.bus_number = bus_number
-        self.bus = SMBus(self.bus_number)
+        self.bus = bus if bus is not None else SMBus(self.bus_number)
+        self.health = health if health is not None else BusHealth(self.bus_number)
+        self.initialised = False
+        self._auto_increment = False
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._shadow = [None] * 256
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_skipped = 0
 
     def setup(self):
         """Init the class with bus_number and address"""
         self.logger.info('Resetting PCA9685 MODE1 (without SLEEP) and MODE2')
+        self.invalidate_cache()
         self.write_all_value(0, 0)
         self._write_byte_data(self._MODE2, self._OUTDRV)
-        self._write_byte_data(self._MODE1, self._ALLCALL)
+        self._write_byte_data(self._MODE1, self._ALLCALL | self._AI)
+        self._auto_increment = True
         time.sleep(0.005)
 
         mode1 = self._read_byte_data(self._MODE1)
         mode1 = mode1 & ~self._SLEEP
         self._write_byte_data(self._MODE1, mode1)
         time.sleep(0.005)
+        self.initialised = True
+
+    def _cached(self, reg, value):
+        """Count a cache lookup and tell whether reg already holds value"""
+        if not self._CACHE_FIRST <= reg <= self._CACHE_LAST:
+            return False
+        if self._shadow[reg] == value:
+            self.cache_hits += 1
+            return True
+        self.cache_misses += 1
+        return False
+
+    def _mirror(self, reg, data):
+        """Record successfully written bytes in the shadow registers"""
+        for i, value in enumerate(data):
+            self._shadow[reg + i] = value
+            if self._ALL_LED_ON_L <= reg + i <= self._ALL_LED_OFF_H:
+                # ALL_LED_* loads the same byte into every channel
+                for channel in range(self._CHANNELS):
+                    self._shadow[self._LED0_ON_L + 4 * channel + reg + i - self._ALL_LED_ON_L] = value
+
+    def _forget(self, reg, size=1):
+        """Drop shadow entries whose chip state is unknown after an error"""
+        for r in range(reg, reg + size):
+            self._shadow[r] = None
+        if reg <= self._ALL_LED_OFF_H and reg + size > self._ALL_LED_ON_L:
+            for r in range(self._CACHE_FIRST, self._CACHE_LAST + 1):
+                self._shadow[r] = None
 
     def _write_byte_data(self, reg, value):
         """Write data to I2C with self.address"""
-        self.logger.info('Writing value %2X to %2X' % (value, reg))
-        try:
-            self.bus.write_byte_data(self.address, reg, value)
-        except Exception:
-            self._check_i2c()
-            self.logger.exception("Write Data Byte Error.")
+        with self._lock:
+            if self._cached(reg, value):
+                self.cache_skipped += 1
+                return
+            self.logger.debug('Writing value %2X to %2X', value, reg)
+            try:
+                self._transaction(self.bus.write_byte_data, reg, value)
+                self._mirror(reg, [value])
+            except Exception as e:
+                self._forget(reg)
+                self.logger.error("Write Data Byte Error: %s", e)
+
+    def _write_block_data(self, reg, data):
+        """Write consecutive registers starting at reg in one I2C transaction
+
+            Bytes at either end that the shadow says are already on the chip
+            are trimmed off; a block that is entirely unchanged is dropped.
+        """
+        with self._lock:
+            changed = [i for i, value in enumerate(data) if not self._cached(reg + i, value)]
+            if not changed:
+                self.cache_skipped += 1
+                return
+            reg, data = reg + changed[0], data[changed[0]:changed[-1] + 1]
+            if not self._auto_increment:
+                self._enable_auto_increment()
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Writing block %s to %2X', ' '.join('%02X' % d for d in data), reg)
+            try:
+                self._transaction(self.bus.write_i2c_block_data, reg, data)
+                self._mirror(reg, data)
+            except Exception as e:
+                self._forget(reg, len(data))
+                self.logger.error("Write Block Data Error: %s", e)
+
+    def invalidate_cache(self):
+        """Forget all shadow registers, e.g. after a chip reset or a bus error"""
+        with self._lock:
+            self._shadow = [None] * 256
+
+    def resync_cache(self):
+        """Reload the MODE and LED shadow registers from the chip"""
+        with self._lock:
+            self.invalidate_cache()
+            if not self._auto_increment:
+                self._enable_auto_increment()
+            for reg in range(self._MODE1, self._CACHE_LAST + 1, self._BLOCK_MAX):
+                size = min(self._BLOCK_MAX, self._CACHE_LAST + 1 - reg)
+                try:
+                    self._mirror(reg, self._transaction(self.bus.read_i2c_block_data, reg, size))
+                except Exception as e:
+                    self.logger.error("Read Block Data Error: %s", e)
+
+    def cache_stats(self):
+        """Shadow cache counters: register hits/misses and dropped transactions"""
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'skipped': self.cache_skipped}
+
+    def _enable_auto_increment(self):
+        """Set the MODE1 AI bit so block writes walk the register file"""
+        mode1 = self._read_byte_data(self._MODE1)
+        if mode1 is None:
+            return
+        self._write_byte_data(self._MODE1, mode1 | self._AI)
+        self._auto_increment = True
 
     def _read_byte_data(self, reg):
         """Read data from I2C with self.address"""
-        self.logger.info('Reading value from %2X' % reg)
+        self.logger.debug('Reading value from %2X', reg)
         try:
-            results = self.bus.read_byte_data(self.address, reg)
+            results = self._transaction(self.bus.read_byte_data, reg)
+            with self._lock:
+                self._shadow[reg] = results
             return results
         except Exception as e:
-            self._check_i2c()
-            self.logger.exception("Read Data Byte Error.")
+            self.logger.error("Read Data Byte Error: %s", e)
+
+    def _transaction(self, func, *args):
+        """Run a bus call for this chip through the health monitor
+
+            Transient errors are retried with a short backoff; persistent
+            ones start _check_i2c() in the background and, after several in
+            a row, make further calls fail fast until the chip answers again.
+        """
+        return self.health.execute(self.address, func, self.address, *args, diagnose=self._check_i2c)
 
     def _run_command(self, cmd):
         import subprocess
@@ -90,6 +211,11 @@ class PWM(object):
         return status, result
 
     def _check_i2c(self):
+        """Log why the chip does not answer, returns False if it is missing
+
+            Slow (runs i2cdetect), the health monitor calls it off the
+            control thread.
+        """
         from os import listdir
         self.logger.debug('I2C bus number is: %s' % self.bus_number)
         self.logger.debug('Checking I2C device:')
@@ -99,6 +225,9 @@ class PWM(object):
         else:
             self.logger.warning('Seems like I2C have not been set, run "sudo raspi-config" to enable I2C')
         cmd = "i2cdetect -y %s" % self.bus_number
+        # not through the bus arbiter: its worker would be blocked for the
+        # whole run, emergency stops included, and the kernel serialises
+        # i2cdetect's probes with our transactions anyway
         _, output = self._run_command(cmd)
         self.logger.debug('Your PCA9685 address is set to 0x%02X' % self.address)
         self.logger.debug('i2cdetect output: \n%s' % output)
@@ -123,11 +252,12 @@ class PWM(object):
         if "%02X" % self.address in addresses:
             self.logger.error(
                 'Wierd, I2C device is connected, Try to run the program again, If problem stills, email this information to support@sunfounder.com')
+            return True
         else:
             self.logger.error('Device is missing. '
                               'Check the address or wiring of PCA9685 Server driver, or email this information to support@sunfounder.com'
                               )
-            quit()
+            return False
 
     @property
     def frequency(self):
@@ -154,26 +284,145 @@ class PWM(object):
         time.sleep(0.005)
         self._write_byte_data(self._MODE1, old_mode | 0x80)
 
+    @staticmethod
+    def _led_bytes(on, off):
+        """Split on/off counts into the ON_L, ON_H, OFF_L, OFF_H register bytes"""
+        return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
     def write(self, channel, on, off):
         """Set on and off value on specific channel"""
-        self.logger.info('Set channel "%d" to value "%d"' % (channel, off))
-        self._write_byte_data(self._LED0_ON_L + 4 * channel, on & 0xFF)
-        self._write_byte_data(self._LED0_ON_H + 4 * channel, on >> 8)
-        self._write_byte_data(self._LED0_OFF_L + 4 * channel, off & 0xFF)
-        self._write_byte_data(self._LED0_OFF_H + 4 * channel, off >> 8)
+        frame = getattr(self._local, 'frame', None)
+        if frame is not None:
+            frame[channel] = (on, off)
+            return
+        self.logger.debug('Set channel "%d" to value "%d"', channel, off)
+        self._write_block_data(self._LED0_ON_L + 4 * channel, self._led_bytes(on, off))
 
     def write_all_value(self, on, off):
         """Set on and off value on all channel"""
-        self.logger.info('Set all channel to value "%d"' % off)
-        self._write_byte_data(self._ALL_LED_ON_L, on & 0xFF)
-        self._write_byte_data(self._ALL_LED_ON_H, on >> 8)
-        self._write_byte_data(self._ALL_LED_OFF_L, off & 0xFF)
-        self._write_byte_data(self._ALL_LED_OFF_H, off >> 8)
+        self.logger.debug('Set all channel to value "%d"', off)
+        self._write_block_data(self._ALL_LED_ON_L, self._led_bytes(on, off))
+
+    def all_off(self):
+        """Switch every channel fully off with a single ALL_LED block write
+
+            Meant for emergency stops: it ignores open frames and the shadow
+            cache, never waits for the PWM lock and jumps the bus queue.
+            Before auto increment is on it is a single byte write of the full
+            off bit to ALL_LED_OFF_H instead.
+        """
+        bus_arbiter = getattr(self.bus, 'arbiter', None)
+        bus = bus_arbiter.bus if bus_arbiter is not None else self.bus
+        if self._auto_increment:
+            reg, data = self._ALL_LED_ON_L, self._led_bytes(0, self._FULL)
+            write, args = bus.write_i2c_block_data, (self.address, reg, data)
+        else:
+            # enabling auto increment would take the lock; the full off bit
+            # in ALL_LED_OFF_H alone already switches every channel off
+            reg, data = self._ALL_LED_OFF_H, [self._FULL >> 8]
+            write, args = bus.write_byte_data, (self.address, reg, data[0])
+        try:
+            if bus_arbiter is not None:
+                bus_arbiter.call(PRIORITY_EMERGENCY, write, *args)
+            else:
+                write(*args)
+        except Exception:
+            self._forget(reg, len(data))
+            self.logger.exception("All LED Off Error.")
+            raise
+        # record the stop, but not behind a wedged writer holding the lock:
+        # forgetting the registers instead only costs uncached writes
+        if self._lock.acquire(blocking=False):
+            try:
+                self._mirror(reg, data)
+            finally:
+                self._lock.release()
+        else:
+            self._forget(reg, len(data))
+
+    def begin_frame(self):
+        """Start staging channel writes for this thread instead of sending them"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        if self._local.depth == 1:
+            self._local.frame = {}
+
+    def commit_frame(self):
+        """Close the current frame; the outermost close sends every staged channel"""
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            raise RuntimeError('commit_frame() called without begin_frame()')
+        self._local.depth = depth - 1
+        if self._local.depth:
+            return
+        frame = self._local.frame
+        self._local.frame = None
+        self.write_channels(frame)
+
+    def discard_frame(self):
+        """Close the current frame; the outermost close drops every staged channel"""
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            raise RuntimeError('discard_frame() called without begin_frame()')
+        self._local.depth = depth - 1
+        if not self._local.depth:
+            self._local.frame = None
+
+    def frame(self):
+        """Context manager staging all writes of the block into one commit
+
+            If the block raises nothing is sent, so a half built frame (one
+            motor updated, the other not) never reaches the chip.
+
+            with pwm.frame():
+                pwm.write(4, 0, left)
+                pwm.write(5, 0, right)
+        """
+        return _Frame(self)
+
+    def write_channels(self, channels):
+        """Write a {channel: (on, off)} mapping in the fewest contiguous block writes"""
+        if not channels:
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Commit channels %s', sorted(channels))
+        per_block = self._BLOCK_MAX // 4
+        run = []
+        for channel in sorted(channels):
+            if run and (channel != run[-1] + 1 or len(run) == per_block):
+                self._write_run(run, channels)
+                run = []
+            run.append(channel)
+        self._write_run(run, channels)
+
+    def _write_run(self, run, channels):
+        data = []
+        for channel in run:
+            data.extend(self._led_bytes(*channels[channel]))
+        self._write_block_data(self._LED0_ON_L + 4 * run[0], data)
 
     def map(self, x, in_min, in_max, out_min, out_max):
         """To map the value from arange to another"""
         return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
+
+class _Frame(object):
+    """Context manager returned by PWM.frame()"""
+
+    def __init__(self, pwm):
+        self._pwm = pwm
+
+    def __enter__(self):
+        self._pwm.begin_frame()
+        return self._pwm
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._pwm.commit_frame()
+        else:
+            self._pwm.discard_frame()
+        return False
+
+
 if __name__ == '__main__':
     import time
 
@@ -11,13 +11,11 @@
 *               Cavon    2016-09-21    Change channel from 1 to all
 **********************************************************************
 """
-import sys
-import pathlib
 import logging
+import time
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-
-from PCA9685 import PWM
+from . import calibration
+from . import devices
 
 
 class Servo(object):
@@ -26,8 +24,12 @@ class Servo(object):
     _MAX_PULSE_WIDTH = 2400
     _DEFAULT_PULSE_WIDTH = 1500
     _FREQUENCY = 60
+    # motion model: degrees per second under load, and the time it takes
+    # to stop oscillating after arriving
+    _SLEW_RATE = 400.0
+    _SETTLE_TIME = 0.02
 
-    def __init__(self, channel, offset=0, lock=True, bus_number=1, address=0x40):
+    def __init__(self, channel, offset=0, lock=True, bus_number=1, address=0x40, slew_rate=None, settle_time=None):
         """ Init a servo on specific channel, this offset """
         self.logger = logging.getLogger(__name__)
         if channel < 0 or channel > 16:
@@ -35,27 +37,44 @@ class Servo(object):
         self.channel = channel
         self.offset = offset
         self.lock = lock
-        self.pwm = PWM(bus_number=bus_number, address=address)
+        self.slew_rate = self._SLEW_RATE if slew_rate is None else slew_rate
+        self.settle_time = self._SETTLE_TIME if settle_time is None else settle_time
+        # commanded angle, the move towards it and when it will be over
+        self.angle = None
+        self._move_from = None
+        self._move_start = 0.0
+        self._move_duration = 0.0
+        self.settled_at = 0.0
+        self.pwm = devices.get_pwm(bus_number=bus_number, address=address)
         self.frequency = self._FREQUENCY
         self.write(90)
 
     def setup(self):
-        self.pwm.setup()
+        # The PCA9685 is shared with the motors, only reset it if nobody has
+        if not self.pwm.initialised:
+            self.pwm.setup()
 
     def _angle_to_analog(self, angle):
         """ Calculate 12-bit analog value from giving angle """
-        pulse_wide = self.pwm.map(angle, 0, 180, self._MIN_PULSE_WIDTH, self._MAX_PULSE_WIDTH)
-        analog_value = int(float(pulse_wide) / 1000000 * self.frequency * 4096)
-        self.logger.debug('Angle %d equals Analog_value %d' % (angle, analog_value))
+        analog_value = calibration.angle_to_count(angle, self.frequency, self._MIN_PULSE_WIDTH, self._MAX_PULSE_WIDTH)
+        self.logger.debug('Angle %d equals Analog_value %d', angle, analog_value)
         return analog_value
 
+    @property
+    def table(self):
+        """ Angle lookup table for the current frequency and offset """
+        if self._table is None:
+            self._table = calibration.servo_table(self.frequency, self.offset,
+                                                  self._MIN_PULSE_WIDTH, self._MAX_PULSE_WIDTH)
+        return self._table
+
     @property
     def frequency(self):
         return self._frequency
     @frequency.setter
     def frequency(self, value):
-        self._frequency = value
-        self.pwm.frequency = value
+        self._frequency = devices.request_frequency(self.pwm, value)
+        self._table = None
 
     @property
     def offset(self):
@@ -65,6 +84,7 @@ class Servo(object):
     def offset(self, value):
         """ Set offset for much user-friendly """
         self._offset = value
+        self._table = None
         self.logger.debug('Set offset to %d' % self.offset)
 
     def write(self, angle):
@@ -77,10 +97,50 @@ class Servo(object):
         else:
             if angle < 0 or angle > 180:
                 raise ValueError("Servo \"{0}\" turn angle \"{1}\" is not in (0, 180).".format(self.channel, angle))
-        val = self._angle_to_analog(angle)
-        val += self.offset
-        self.pwm.write(self.channel, 0, val)
-        self.logger.info('Turn angle = %d' % angle)
+        self.pwm.write(self.channel, 0, self.table.lookup(angle))
+        self._track(angle)
+        self.logger.debug('Turn angle = %s', angle)
+
+    def _track(self, angle):
+        now = time.monotonic()
+        position = self.position
+        # nobody knows where the horn is before the first write, assume the worst
+        distance = 180 if position is None else abs(angle - position)
+        self._move_from = angle if position is None else position
+        self._move_start = now
+        self._move_duration = distance / self.slew_rate
+        self.angle = angle
+        # a pending settle is not cut short by a write that does not move
+        self.settled_at = max(now + self._move_duration + self.settle_time if distance else 0.0,
+                              self.settled_at)
+
+    @property
+    def position(self):
+        """ Estimated current angle, None before the first write """
+        if self.angle is None:
+            return None
+        elapsed = time.monotonic() - self._move_start
+        if elapsed >= self._move_duration:
+            return self.angle
+        return self._move_from + (self.angle - self._move_from) * elapsed / self._move_duration
+
+    @property
+    def is_settled(self):
+        return time.monotonic() >= self.settled_at
+
+    def settle_remaining(self):
+        """ Seconds until the servo has arrived and settled, 0 if it has """
+        return max(0.0, self.settled_at - time.monotonic())
+
+    def wait_settled(self, timeout=None):
+        """ Sleep until settled, at most timeout seconds. True if settled """
+        remaining = self.settle_remaining()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            return False
+        if remaining:
+            time.sleep(remaining)
+        return True
 
 
 if __name__ == '__main__':
@@ -38,6 +38,8 @@ class Motor(object):
 
         self.backward_offset = not self.forward_offset
         self._speed = 0
+        # level last written to the direction pin, None if unknown
+        self._level = None
 
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
@@ -53,31 +55,50 @@ class Motor(object):
 
     @speed.setter
     def speed(self, speed):
-        """ Set Speed with giving value """
-        if speed not in range(0, 101):
+        """ Set Speed with giving value, fractions of a percent are fine """
+        if not 0 <= speed <= 100:
             raise ValueError('speed ranges from 0 to 100, not "{0}"'.format(speed))
         if not callable(self._pwm):
             raise ValueError(
                 'pwm is not callable, please set Motor.pwm to a pwm control function with only 1 variable speed')
-        self.logger.info('Set speed to: %s' % speed)
+        self.logger.debug('Set speed to: %s', speed)
         self._speed = speed
         self._pwm(self._speed)
 
+    def _direction(self, level):
+        GPIO.output(self.direction_channel, level)
+        self._level = level
+
     def forward(self):
         """ Set the motor direction to forward """
-        GPIO.output(self.direction_channel, self.forward_offset)
+        self._direction(self.forward_offset)
         self.speed = self._speed
-        self.logger.info('Motor moving forward (%s)' % str(self.forward_offset))
+        self.logger.debug('Motor moving forward (%s)', self.forward_offset)
 
     def backward(self):
         """ Set the motor direction to backward """
-        GPIO.output(self.direction_channel, self.backward_offset)
+        self._direction(self.backward_offset)
         self.speed = self._speed
-        self.logger.info('Motor moving backward (%s)' % str(self.backward_offset))
+        self.logger.debug('Motor moving backward (%s)', self.backward_offset)
+
+    def drive(self, speed):
+        """ Signed speed from -100 to 100, negative runs backward
+
+            The direction pin is only written when it changes, and not at all
+            at speed 0. An unchanged duty cycle is left to the pwm function
+            to skip (the PCA9685 shadow registers do).
+        """
+        if not -100 <= speed <= 100:
+            raise ValueError('speed ranges from -100 to 100, not "{0}"'.format(speed))
+        if speed:
+            level = self.forward_offset if speed > 0 else self.backward_offset
+            if level != self._level:
+                self._direction(level)
+        self.speed = abs(speed)
 
     def stop(self):
         """ Stop the motor by giving a 0 speed """
-        self.logger.info('Motor stop')
+        self.logger.debug('Motor stop')
         self.speed = 0
 
     @property
@@ -91,6 +112,7 @@ class Motor(object):
             raise ValueError('offset value must be Bool value, not"{0}"'.format(value))
         self.forward_offset = value
         self.backward_offset = not self.forward_offset
+        self._level = None
         self.logger.info('Set offset to %d' % self._offset)
 
     @property
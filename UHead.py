@@ -1,18 +1,16 @@
 #!/usr/bin/env python3
 
 import os
-import sys
 import time
-import json
-import pathlib
 import logging
-from multiprocessing import Process, Value
+import threading
+from multiprocessing import Lock, Process, Value
 
 import RPi.GPIO as GPIO
 
-sys.path.insert(0, str(pathlib.Path(__file__).parent))
-
-from Servo import Servo
+from . import config
+from . import filters
+from .Servo import Servo
 
 
 class UHead(object):
@@ -20,21 +18,43 @@ class UHead(object):
     HEADER_CHANNEL = 3
     U_CHANNEL = 20
     TIMEOUT = 0.05
+    # quiet time on the pin between the end of one echo and the next trigger
+    SETTLE = 0.01
+    # shortest trigger to trigger time, echoes of the previous burst from
+    # up to ~4 m away must have died down or they read as near ghosts
+    PING_INTERVAL = 0.025
+    # trigger to rising echo edge plus edge callback latency
+    ECHO_LATENCY = 0.002
+    # speed of sound in cm per ns, halved for the way there and back
+    _CM_PER_NS = 343.2 * 100 / 1e9 / 2
     MOUNT = 5
+    # get_distance() pings again once the shared reading is older than this
+    MAX_AGE = 0.1
     ALARM_GATE = 20
+    # get_reading() when the filter dropped the ping, never a distance
+    NO_READING = -1
+    # head angles of a background scan, swept back and forth
+    SCAN_ANGLES = (0, 30, 60, 90, 120, 150, 180)
 
     def __init__(self, db="config.json", bus_number=1, u_header=U_CHANNEL, header_channel=HEADER_CHANNEL):
         """ setup channels and basic stuff """
         self.logger = logging.getLogger(__name__)
         try:
-            with open(os.path.join(os.getcwd(), db), 'r') as configFile:
-                jsondata = configFile.read()
-            self.db = json.loads(jsondata)
+            # shared with every other driver reading the same file
+            self.db = config.get_config(db)
+            self.db.require("head_offset", "turning_offset")
 
             # -> Header Servo
             self._header_channel = header_channel
-            self.head = Servo(self._header_channel, bus_number=bus_number, offset=self.db["head_offset"])
+            # optional "head_slew_rate" (degrees/s) and "head_settle_time" (s)
+            self.head = Servo(self._header_channel, bus_number=bus_number, offset=self.db["head_offset"],
+                              slew_rate=self.db.get("head_slew_rate"), settle_time=self.db.get("head_settle_time"))
             self.head.setup()
+            # the head's Servo.settled_at, visible to the measurement process
+            self._head_settled_at = Value('d', 0.0, lock=False)
+            # every reading goes through it before it is shared, see filters;
+            # reset whenever the head turns, its history is of one direction
+            self.filter = filters.default_chain(self.MOUNT)
 
             self._straight_angle = 90
             self.turning_max = 90
@@ -44,8 +64,33 @@ class UHead(object):
             # -> U Sensor GPIOs
             self._u_channel = u_header
             GPIO.setmode(GPIO.BCM)
+            # shared with the measurement process: one ping at a time on the pin
+            self._ping_lock = Lock()
+            self._last_echo_ns = Value('q', 0, lock=False)
+            self._last_trigger_ns = Value('q', 0, lock=False)
+            self._pings = Value('q', 0, lock=False)
+            # farthest distance the measurement process has to see, 0 for all
+            self._range = Value('f', 0, lock=False)
+            self._rate_pings = 0
+            self._rate_time = time.monotonic()
+            self._edge_events = True
+            # pid of the process the edge detection is registered in
+            self._edge_pid = None
+            # (perf_counter_ns(), level) of the pin's edges while a ping listens
+            self._echo_end = None
+            self._echo_done = threading.Event()
             self.killSwitch = Value('i', 1)
             self.distance = Value('f', 0)
+            # time.monotonic() of the reading in distance, 0 before the first
+            self.distance_time = Value('d', 0.0, lock=False)
+            self.p = None
+
+            # polar range map of the background scan, one slot per angle
+            self._scan_lock = threading.Lock()
+            self._scan_stopped = threading.Event()
+            self._scan_thread = None
+            self._set_scan_angles(self.SCAN_ANGLES)
+            self.sweeps = 0
 
             self.logger.info('UHead PWM channel: %s' % self._header_channel)
             self.logger.info('UHead offset value: %s ' % self.turning_offset)
@@ -55,66 +100,330 @@ class UHead(object):
             self.logger.info("CWD: %s" % os.getcwd())
             self.logger.exception("Can't open/read config pls. Please specify the path relative to your main.py file")
             raise Exception from e
+        except KeyError as e:
+            self.logger.exception("Config value missing")
+            raise Exception from e
         except ValueError as e:
             self.logger.exception("Json value error")
             raise Exception from e
 
-    def u_distance(self):
-        pulse_end = 0
-        pulse_start = 0
+    def echo_timeout(self, max_distance):
+        """ Seconds to wait for the echo of something max_distance cm away """
+        return self.ECHO_LATENCY + max_distance / self._CM_PER_NS / 1e9
+
+    def _trigger(self):
+        # only wait for whatever is left of the settle time since the last
+        # echo and of the ping interval since the last trigger
+        now = time.perf_counter_ns()
+        remaining = max(self.SETTLE - (now - self._last_echo_ns.value) / 1e9,
+                        self.PING_INTERVAL - (now - self._last_trigger_ns.value) / 1e9)
         GPIO.setup(self._u_channel, GPIO.OUT)
         GPIO.output(self._u_channel, False)
-        time.sleep(0.01)
+        if remaining > 0:
+            time.sleep(remaining)
         GPIO.output(self._u_channel, True)
+        self._last_trigger_ns.value = time.perf_counter_ns()
         time.sleep(0.00001)
         GPIO.output(self._u_channel, False)
         GPIO.setup(self._u_channel, GPIO.IN)
-
-        timeout_start = time.time()
+        self._pings.value += 1
+
+    def _arm_edges(self):
+        # arming edge detection takes milliseconds, so it is registered once
+        # per process (callbacks do not survive the fork of the measurement
+        # process) and stays armed between pings
+        if self._edge_pid == os.getpid():
+            return
+        GPIO.add_event_detect(self._u_channel, GPIO.BOTH, callback=self._edge)
+        self._edge_pid = os.getpid()
+
+    def _edge(self, channel):
+        # every edge while a ping listens, in order, with the pin level
+        edges = self._echo_end
+        if edges is not None:
+            edges.append((time.perf_counter_ns(), GPIO.input(self._u_channel)))
+            self._echo_done.set()
+
+    def _echo_edges(self, timeout):
+        """ perf_counter_ns() of the echo's rising and falling edge
+
+            Fewer than two if the echo did not start or end within timeout.
+
+            The echo starts within ECHO_LATENCY of the trigger whatever the
+            range, so only that long is polled for it; the calling thread
+            then sleeps on an event until the falling edge. Both timestamps
+            are taken in the callbacks of the edge detection _arm_edges()
+            keeps registered, so the callback latency cancels out.
+        """
+        self._arm_edges()
+        started = time.perf_counter_ns()
+        deadline = started + int(timeout * 1e9)
+        edges = []
+        self._echo_end = edges
+        try:
+            rise_deadline = started + int(min(timeout, self.ECHO_LATENCY) * 1e9)
+            while GPIO.input(self._u_channel) == 0:
+                if time.perf_counter_ns() > rise_deadline:
+                    return []
+            pulse_start = time.perf_counter_ns()
+            checked = 0
+            while True:
+                self._echo_done.clear()
+                while checked < len(edges):
+                    timestamp, level = edges[checked]
+                    # late callbacks of the trigger pulse read the echo high,
+                    # the first low after the echo started is its end
+                    if level == 0 and timestamp >= pulse_start:
+                        rise = edges[checked - 1][0] if checked else 0
+                        if rise < pulse_start:
+                            # rise and fall came as one event, a very short echo
+                            rise = pulse_start
+                        return [rise, timestamp]
+                    checked += 1
+                remaining = deadline - time.perf_counter_ns()
+                if remaining <= 0:
+                    return [pulse_start]
+                self._echo_done.wait(remaining / 1e9)
+        finally:
+            self._echo_end = None
+
+    def _poll_edges(self, timeout):
+        """ Same as _echo_edges() by polling, for kernels without edge events """
+        started = time.perf_counter_ns()
+        deadline = started + int(timeout * 1e9)
+        rise_deadline = started + int(min(timeout, self.ECHO_LATENCY) * 1e9)
         while GPIO.input(self._u_channel) == 0:
-            pulse_start = time.time()
-            if pulse_start - timeout_start > self.TIMEOUT:
-                return -1
+            if time.perf_counter_ns() > rise_deadline:
+                return []
+        pulse_start = time.perf_counter_ns()
         while GPIO.input(self._u_channel) == 1:
-            pulse_end = time.time()
-            if pulse_start - timeout_start > self.TIMEOUT:
-                return -1
-        if pulse_start != 0 and pulse_end != 0:
-            pulse_duration = pulse_end - pulse_start
-            # Sekunden * 100 (fuer cm) * Schallgeschw in m/s /(hin plus zurueck)
-            distance = pulse_duration * 100 * 343.2 / 2
-            distance = int(distance)
-            self.logger.debug('start: %s, end: %s' % (pulse_start, pulse_end))
-            if distance >= 0:
-                return distance  # in cm
-            else:
-                return -1
-        else:
-            self.logger.debug('start: %s, end: %s' % (pulse_start, pulse_end))
+            if time.perf_counter_ns() > deadline:
+                return [pulse_start]
+        return [pulse_start, time.perf_counter_ns()]
+
+    def u_distance(self, timeout=None, max_distance=None):
+        """ One ping, distance in cm or -1 if no echo came back within timeout seconds
+
+            With max_distance (cm) the timeout is just long enough for that
+            range, and an echo still running then returns float('inf'):
+            nothing within max_distance.
+        """
+        if max_distance:
+            timeout = self.echo_timeout(max_distance)
+        elif timeout is None:
+            timeout = self.TIMEOUT
+        with self._ping_lock:
+            self._trigger()
+            edges = []
+            if self._edge_events:
+                try:
+                    edges = self._echo_edges(timeout)
+                except RuntimeError as e:
+                    self.logger.warning('No GPIO edge events on %s (%s), polling the echo', self._u_channel, e)
+                    self._edge_events = False
+            if not self._edge_events:
+                edges = self._poll_edges(timeout)
+            self._last_echo_ns.value = time.perf_counter_ns()
+        if len(edges) == 1 and max_distance:
+            return float('inf')
+        if len(edges) < 2:
+            self.logger.debug('No echo within %s s', timeout)
             return -1
+        pulse_start, pulse_end = edges
+        self.logger.debug('start: %s, end: %s', pulse_start, pulse_end)
+        return int((pulse_end - pulse_start) * self._CM_PER_NS)  # in cm
 
-    def measure(self, mount=MOUNT):
+    def measure(self):
         self.logger.debug("Start Process ..")
+        settled_at = self._head_settled_at.value
         while self.killSwitch.value:
-            sum_of_distances = 0
-            for i in range(mount):
-                sum_of_distances += self.u_distance()
-            self.distance.value = sum_of_distances / mount
-            self.logger.debug("Measured %s cm" % self.distance.value)
+            self._wait_head()
+            if self._head_settled_at.value != settled_at:
+                # _write_head() resets the filter of the other process only
+                settled_at = self._head_settled_at.value
+                self.filter.reset()
+            raw = self.u_distance(max_distance=self._range.value)
+            if raw == float('inf'):
+                # nothing in range is a reading too, but not one to smooth,
+                # and older close readings must not outvote the next pings
+                self.filter.reset()
+                self._store(raw)
+                continue
+            distance = self.filter.update(raw, time.monotonic())
+            if distance is None:
+                # shared too, so readers do not all ping again right away
+                self._store(self.NO_READING)
+            else:
+                self._store(distance)
+                self.logger.debug("Measured %s cm", distance)
         self.logger.debug("Kill Process ..")
 
-    def get_distance(self):
-        return self.u_distance()
+    def _store(self, distance):
+        timestamp = time.monotonic()
+        with self.distance.get_lock():
+            self.distance.value = distance
+            self.distance_time.value = timestamp
+        return timestamp
+
+    def get_reading(self, max_age=MAX_AGE, max_distance=None):
+        """ (distance, time.monotonic() it was measured at)
+
+            Returns the shared reading of the measurement process while it is
+            at most max_age seconds old and was taken since the head settled,
+            pings right away otherwise. If the filter drops that ping the
+            distance is NO_READING. A ping limited to max_distance cm returns
+            float('inf') if nothing is that close. Both are shared and
+            timestamped like any other reading, max_age applies to them too.
+        """
+        with self.distance.get_lock():
+            distance = self.distance.value
+            timestamp = self.distance_time.value
+        fresh = timestamp and time.monotonic() - timestamp <= max_age
+        if fresh and timestamp >= self._head_settled_at.value:
+            return distance, timestamp
+        self._wait_head()
+        raw = self.u_distance(max_distance=max_distance)
+        if raw == float('inf'):
+            self.filter.reset()
+            return raw, self._store(raw)
+        filtered = self.filter.update(raw, time.monotonic())
+        if filtered is None:
+            return self.NO_READING, self._store(self.NO_READING)
+        return filtered, self._store(filtered)
+
+    def latest_reading(self):
+        """ The shared (distance, time.monotonic()) as it is, never pings
+
+            (0, 0.0) before the first reading.
+        """
+        with self.distance.get_lock():
+            return self.distance.value, self.distance_time.value
+
+    def get_distance(self, max_age=MAX_AGE, max_distance=None):
+        """ Distance in cm at most max_age seconds old, 0 forces a new ping
+
+            max_distance is the farthest distance the caller cares about,
+            shorter ranges ping faster, see get_reading().
+        """
+        return self.get_reading(max_age, max_distance)[0]
+
+    def set_range(self, max_distance=None):
+        """ Let the measurement process only look max_distance cm far
+
+            Readings beyond it become float('inf'), in exchange the echo
+            timeout shrinks and pings come as fast as PING_INTERVAL allows.
+            None goes back to the full range.
+        """
+        self._range.value = max_distance or 0
+
+    def pings_per_second(self):
+        """ Pings of both processes per second since the last call """
+        now = time.monotonic()
+        pings = self._pings.value
+        rate = (pings - self._rate_pings) / (now - self._rate_time) if now > self._rate_time else 0.0
+        self._rate_pings = pings
+        self._rate_time = now
+        return rate
 
     def start_measurement_process(self):
         self.logger.info("Start measuring process..")
+        self.killSwitch.value = 1
         self.p = Process(target=self.measure)
         self.p.start()
 
     def stop_measurement_process(self):
+        if self.p is None:
+            return
         self.logger.info("Stop measuring process..")
         self.killSwitch.value = 0
         self.p.join()
+        self.p = None
+
+    def _set_scan_angles(self, angles):
+        with self._scan_lock:
+            self.scan_angles = tuple(angles)
+            self._scan_distances = [-1.0] * len(self.scan_angles)
+            self._scan_times = [0.0] * len(self.scan_angles)
+        # drops timeouts and junk echoes, a slot keeps its last good reading
+        self._scan_gate = filters.FilterChain(filters.DropInvalid(), filters.RangeGate())
+
+    @property
+    def scanning(self):
+        return self._scan_thread is not None and self._scan_thread.is_alive()
+
+    def start_scan(self, angles=None):
+        """ Keep sweeping the head over angles and ping at each one
+
+            Runs on a thread of this process; it owns the head until
+            stop_scan(), so the measurement process (which assumes the head
+            looks straight ahead) is stopped first. Read scan_map(),
+            sectors() or scanned_distance() instead of turning the head.
+        """
+        if self.scanning:
+            return
+        self.stop_measurement_process()
+        if angles is not None:
+            self._set_scan_angles(angles)
+        self._scan_stopped.clear()
+        self._scan_thread = threading.Thread(target=self._scan, name='uhead-scan', daemon=True)
+        self._scan_thread.start()
+        self.logger.info('Scanning %s', self.scan_angles)
+
+    def stop_scan(self):
+        self._scan_stopped.set()
+        if self._scan_thread is not None:
+            self._scan_thread.join()
+            self._scan_thread = None
+        self.turn_straight()
+
+    def _scan(self):
+        sweep = list(range(len(self.scan_angles)))
+        sweep += sweep[-2:0:-1]
+        while not self._scan_stopped.is_set():
+            for slot in sweep:
+                self.turn(self.scan_angles[slot])
+                if self._scan_stopped.wait(self.head.settle_remaining()):
+                    return
+                timestamp = time.monotonic()
+                distance = self._scan_gate.update(self.u_distance(), timestamp)
+                if distance is None:
+                    continue
+                with self._scan_lock:
+                    self._scan_distances[slot] = distance
+                    self._scan_times[slot] = timestamp
+                if self.scan_angles[slot] == self._straight_angle:
+                    self._store(distance)
+            self.sweeps += 1
+
+    def scan_map(self):
+        """ Polar range map: (angle, distance in cm, time.monotonic()) per scan angle
+
+            distance is -1 and time 0 for angles without a reading yet.
+        """
+        with self._scan_lock:
+            return list(zip(self.scan_angles, self._scan_distances, self._scan_times))
+
+    def scanned_distance(self, angle):
+        """ (distance, time.monotonic()) of the scan angle nearest to angle """
+        with self._scan_lock:
+            slot = min(range(len(self.scan_angles)), key=lambda i: abs(self.scan_angles[i] - angle))
+            return self._scan_distances[slot], self._scan_times[slot]
+
+    def sectors(self, angles=None, radius=ALARM_GATE, max_age=None):
+        """ Occupied (True) / free (False) per angle, from the nearest scan angle
+
+            A slot without a reading, or one older than max_age seconds,
+            counts as occupied.
+        """
+        if angles is None:
+            angles = self.scan_angles
+        now = time.monotonic()
+        vision = []
+        for angle in angles:
+            distance, timestamp = self.scanned_distance(angle)
+            stale = not timestamp or (max_age is not None and now - timestamp > max_age)
+            vision.append(stale or distance < radius)
+        return vision
 
     def less_than(self, angle=None, alarm_gate=ALARM_GATE):
         dist = self.get_distance()
@@ -125,32 +434,52 @@ class UHead(object):
             state = 0
         else:
             state = -1
-        self.logger.info('distance: %s, status: %s' % dist, state)
+        self.logger.debug('distance: %s, status: %s', dist, state)
         return state
 
     def turn_left(self):
         """ Turn the front heads left """
-        self.logger.info('Turn left')
-        self.head.write(self._angle["left"])
+        self.logger.debug('Turn left')
+        self._write_head(self._angle["left"])
 
     def turn_straight(self):
         """ Turn the front heads back straight """
-        self.logger.info('Turn straight')
-        self.head.write(self._angle["straight"])
+        self.logger.debug('Turn straight')
+        self._write_head(self._angle["straight"])
 
     def turn_right(self):
         """ Turn the front heads right """
-        self.logger.info('Turn right')
-        self.head.write(self._angle["right"])
+        self.logger.debug('Turn right')
+        self._write_head(self._angle["right"])
 
     def turn(self, angle):
         """ Turn the front heads to the giving angle """
-        self.logger.info('Turn to %s ' % angle)
+        self.logger.debug('Turn to %s ', angle)
         if angle < self._angle["left"]:
             angle = self._angle["left"]
         if angle > self._angle["right"]:
             angle = self._angle["right"]
+        self._write_head(angle)
+
+    def _write_head(self, angle):
         self.head.write(angle)
+        self.filter.reset()
+        self._head_settled_at.value = self.head.settled_at
+
+    def _wait_head(self):
+        # never ping while the head is still turning, in either process
+        remaining = self._head_settled_at.value - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    @property
+    def is_settled(self):
+        """ False while the head is still moving to the last commanded angle """
+        return time.monotonic() >= self._head_settled_at.value
+
+    def wait_settled(self, timeout=None):
+        """ Sleep until the head has arrived, see Servo.wait_settled() """
+        return self.head.wait_settled(timeout)
 
     @property
     def header_channel(self):
@@ -218,8 +547,8 @@ class UHead(object):
 
     def cali_ok(self):
         """ Save the calibration value """
+        # the turning_offset setter saves it
         self.turning_offset = self.cali_turning_offset
-        self.db['turning_offset'] = self.turning_offset
 
 
 if __name__ == '__main__':
@@ -1,9 +1,33 @@
-import logging
-import sys
-
-from .Backwheels import Backwheels
-from .Linefollower import Linefollower
-from .PCA9685 import PWM
-from .Servo import Servo
-from .TB6612 import Motor
-from .UHead import UHead
+import importlib
+
+# Driver classes are imported on first access so that "import picar" stays
+# cheap and does not need smbus2/RPi.GPIO until hardware is really used.
+_EXPORTS = {
+    'Backwheels': 'Backwheels',
+    'Linefollower': 'Linefollower',
+    'PWM': 'PCA9685',
+    'Servo': 'Servo',
+    'Motor': 'TB6612',
+    'UHead': 'UHead',
+    'Hardware': 'hardware',
+    'Watchdog': 'watchdog',
+}
+_SUBMODULES = ('arbiter', 'calibration', 'config', 'devices', 'filters', 'hardware', 'health',
+               'logconfig', 'motion', 'pid', 'sampler', 'scheduler', 'steering', 'thresholds', 'watchdog')
+
+__all__ = list(_EXPORTS) + list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Prioritised arbitration of one I2C bus.
+
+All transactions on a bus are queued and executed by one worker thread,
+lowest priority number first, so motor commands and line sensor reads
+are never stuck behind diagnostics. A multiprocessing lock around every
+transaction also serialises forked processes (e.g. the UHead measurement
+process), which execute their transactions directly under that lock
+because the worker thread does not survive the fork.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+PRIORITY_EMERGENCY = 0
+PRIORITY_ACTUATOR = 10
+PRIORITY_SENSOR = 20
+PRIORITY_DEFAULT = 50
+PRIORITY_DIAGNOSTIC = 90
+
+
+class BusArbiter(object):
+    """ Serialises and prioritises all transactions of one bus """
+
+    def __init__(self, bus, bus_number=1):
+        self.logger = logging.getLogger(__name__)
+        self.bus = bus
+        self.bus_number = bus_number
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._process_lock = multiprocessing.Lock()
+        self._pid = os.getpid()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self.max_depth = 0
+        # a fork while another thread holds one of these would leave it
+        # locked for good in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='i2c-%d' % self.bus_number, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            priority, _, submitted, future, func, args = self._queue.get()
+            if future is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                with self._process_lock:
+                    result = func(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self._account(priority, started - submitted, time.perf_counter() - started)
+
+    def _account(self, priority, waited, took):
+        with self._stats_lock:
+            stats = self._stats.get(priority)
+            if stats is None:
+                stats = self._stats[priority] = {'count': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'busy_total': 0.0}
+            stats['count'] += 1
+            stats['wait_total'] += waited
+            stats['busy_total'] += took
+            if waited > stats['wait_max']:
+                stats['wait_max'] = waited
+
+    def _inline(self):
+        # The worker itself (nested calls) and forked children, which have
+        # no worker thread, run the transaction directly
+        return os.getpid() != self._pid or threading.current_thread() is self._thread
+
+    def submit(self, priority, func, *args):
+        """ Queue func(*args) and return a concurrent.futures.Future """
+        if self._inline():
+            future = Future()
+            future.set_running_or_notify_cancel()
+            started = time.perf_counter()
+            try:
+                with self._process_lock:
+                    future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            self._account(priority, 0.0, time.perf_counter() - started)
+            return future
+        if self._thread is None:
+            self._start()
+        future = Future()
+        self._queue.put((priority, next(self._sequence), time.perf_counter(), future, func, args))
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return future
+
+    def call(self, priority, func, *args):
+        """ Run func(*args) on the bus and return its result (or raise its error) """
+        return self.submit(priority, func, *args).result()
+
+    def view(self, priority=PRIORITY_DEFAULT):
+        """ SMBus look-alike whose transactions go through this arbiter at priority """
+        return ArbitratedBus(self, priority)
+
+    @property
+    def depth(self):
+        """ Number of transactions waiting right now """
+        return self._queue.qsize()
+
+    def stats(self):
+        """ Queue depth and per priority transaction count and wait times (ms) """
+        with self._stats_lock:
+            per_priority = {}
+            for priority, stats in sorted(self._stats.items()):
+                per_priority[priority] = {
+                    'count': stats['count'],
+                    'wait_avg_ms': stats['wait_total'] / stats['count'] * 1000,
+                    'wait_max_ms': stats['wait_max'] * 1000,
+                    'busy_ms': stats['busy_total'] * 1000,
+                }
+        return {'depth': self.depth, 'max_depth': self.max_depth, 'priorities': per_priority}
+
+    def stop(self):
+        """ Stop the worker thread after the already queued transactions """
+        if self._thread is not None:
+            self._queue.put((float('inf'), next(self._sequence), 0.0, None, None, None))
+            self._thread.join()
+            self._thread = None
+
+
+class ArbitratedBus(object):
+    """ Forwards SMBus methods to BusArbiter.call() with a fixed priority """
+
+    def __init__(self, arbiter, priority):
+        self.arbiter = arbiter
+        self.priority = priority
+
+    def __getattr__(self, name):
+        func = getattr(self.arbiter.bus, name)
+        if not callable(func):
+            return func
+
+        def _call(*args):
+            return self.arbiter.call(self.priority, func, *args)
+        return _call
+
+    def submit(self, name, *args):
+        """ Queue bus method name(*args), returns a Future to wait on with a timeout """
+        return self.arbiter.submit(self.priority, getattr(self.arbiter.bus, name), *args)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Precomputed PCA9685 count tables for servos and motors.
+
+The float maths that turns an angle or a speed into a 12-bit PWM count
+only depends on a handful of calibration values (frequency, offset,
+dead zone ...). The tables below evaluate it once per calibration and
+turn every later conversion into an index into an array.
+"""
+import functools
+from array import array
+
+PWM_MAX = 4095
+
+
+def angle_to_count(angle, frequency, min_pulse=600, max_pulse=2400, max_angle=180):
+    """ 12-bit count of the pulse for angle, pulses given in microseconds """
+    pulse_wide = (angle - 0) * (max_pulse - min_pulse) / (max_angle - 0) + min_pulse
+    return int(float(pulse_wide) / 1000000 * frequency * 4096)
+
+
+def speed_to_count(speed, dead_zone=0, gamma=1.0):
+    """ 12-bit count for speed in percent
+
+        dead_zone is the count below which the motor does not turn at all,
+        any speed above 0 starts there; gamma bends the curve above it.
+    """
+    if speed <= 0:
+        return 0
+    return int(dead_zone + (PWM_MAX - dead_zone) * (speed / 100.0) ** gamma)
+
+
+class ServoTable(object):
+    """ angle -> count (offset included) for one servo calibration """
+
+    def __init__(self, frequency, offset=0, min_pulse=600, max_pulse=2400, max_angle=180, resolution=10):
+        self.frequency = frequency
+        self.offset = offset
+        self.max_angle = max_angle
+        self.resolution = resolution
+        self._table = array('H', (min(max(angle_to_count(step / resolution, frequency, min_pulse, max_pulse,
+                                                            max_angle) + offset, 0), PWM_MAX)
+                                  for step in range(max_angle * resolution + 1)))
+
+    def lookup(self, angle):
+        """ Count for angle (0..max_angle), rounded to 1/resolution degree """
+        return self._table[int(angle * self.resolution + 0.5)]
+
+    def __len__(self):
+        return len(self._table)
+
+
+class MotorTable(object):
+    """ speed (0..100 %) -> count for one motor's dead zone curve """
+
+    def __init__(self, dead_zone=0, gamma=1.0, resolution=10):
+        self.dead_zone = dead_zone
+        self.gamma = gamma
+        self.resolution = resolution
+        self._table = array('H', (speed_to_count(step / resolution, dead_zone, gamma)
+                                  for step in range(100 * resolution + 1)))
+
+    def lookup(self, speed):
+        """ Count for speed (0..100), rounded to 1/resolution percent """
+        return self._table[int(speed * self.resolution + 0.5)]
+
+    def __len__(self):
+        return len(self._table)
+
+
+@functools.lru_cache(maxsize=32)
+def servo_table(frequency, offset=0, min_pulse=600, max_pulse=2400, max_angle=180, resolution=10):
+    """ Shared ServoTable, built once per distinct calibration """
+    return ServoTable(frequency, offset, min_pulse, max_pulse, max_angle, resolution)
+
+
+@functools.lru_cache(maxsize=32)
+def motor_table(dead_zone=0, gamma=1.0, resolution=10):
+    """ Shared MotorTable, built once per distinct curve """
+    return MotorTable(dead_zone, gamma, resolution)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Shared calibration config.
+
+Every driver used to open and parse config.json itself. get_config()
+loads a file once per process and hands the same ConfigStore to every
+caller. Changes are written back atomically (temporary file in the same
+directory, fsync, os.replace), so a crash mid-write never leaves a torn
+config behind. Several changes made inside `with store.batch():` go out
+as one write.
+"""
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_stores = {}
+
+
+class MissingKeyError(KeyError):
+    """ The config file lacks keys a driver needs """
+
+    def __str__(self):
+        # KeyError would quote the message
+        return str(self.args[0]) if self.args else ''
+
+
+class ConfigStore(object):
+    """ A JSON object file, read once and saved atomically on change """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._dirty = False
+        self.saves = 0
+        self._data = self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as configFile:
+            data = json.load(configFile)
+        if not isinstance(data, dict):
+            raise ValueError('%s must hold a JSON object, not %s' % (self.path, type(data).__name__))
+        self.logger.info('Loaded config %s' % self.path)
+        return data
+
+    def require(self, *keys):
+        """ Raise MissingKeyError naming every key of keys the file lacks """
+        missing = [key for key in keys if key not in self._data]
+        if missing:
+            raise MissingKeyError('%s is missing %s' % (self.path, ', '.join(missing)))
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def set(self, key, value):
+        """ Change key, saved right away unless inside batch() """
+        with self._lock:
+            if key in self._data and self._data[key] == value:
+                return
+            self._data[key] = value
+            self._dirty = True
+            if not self._batch_depth:
+                self.save()
+
+    __setitem__ = set
+
+    def update(self, values):
+        """ Change several keys with a single save """
+        with self.batch():
+            for key, value in values.items():
+                self.set(key, value)
+
+    def batch(self):
+        """ Context manager collecting set() calls into one save at the end """
+        return _Batch(self)
+
+    def save(self):
+        """ Write the file atomically if anything changed since the last save """
+        with self._lock:
+            if not self._dirty:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            handle, temp_path = tempfile.mkstemp(prefix='.config-', suffix='.json', dir=directory)
+            try:
+                with os.fdopen(handle, 'w') as tempFile:
+                    json.dump(self._data, tempFile, indent=4, sort_keys=True)
+                    tempFile.write('\n')
+                    tempFile.flush()
+                    os.fsync(tempFile.fileno())
+                # mkstemp() creates the file 0600, keep the mode of the original
+                os.chmod(temp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            self._dirty = False
+            self.saves += 1
+            self.logger.info('Saved config %s' % self.path)
+
+    def reload(self):
+        """ Read the file again, dropping unsaved changes """
+        with self._lock:
+            self._data = self._load()
+            self._dirty = False
+
+
+class _Batch(object):
+    """ Context manager returned by ConfigStore.batch() """
+
+    def __init__(self, store):
+        self._store = store
+
+    def __enter__(self):
+        self._store._lock.acquire()
+        self._store._batch_depth += 1
+        return self._store
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._store._batch_depth -= 1
+            if not self._store._batch_depth:
+                self._store.save()
+        finally:
+            self._store._lock.release()
+        return False
+
+
+def get_config(path="config.json"):
+    """ Return the shared ConfigStore of path (relative to the CWD), loading it once """
+    path = os.path.abspath(path)
+    with _lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ConfigStore(path)
+        return store
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Process-wide registry of shared I2C devices.
+
+Every driver on the car talks to the same bus and the same PCA9685, so
+instead of opening a new SMBus handle and re-initialising the chip per
+object, drivers ask this module for the shared instance keyed by
+(bus_number, address). Bus handles are handed out as views of the bus'
+BusArbiter, so all drivers' transactions are serialised by priority.
+"""
+import logging
+import threading
+
+from smbus2 import SMBus
+
+from . import arbiter
+from .health import BusHealth
+from .PCA9685 import PWM
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_buses = {}
+_arbiters = {}
+_healths = {}
+_pwms = {}
+_frequencies = {}
+_conflicts = []
+
+
+def get_arbiter(bus_number=1):
+    """ Return the BusArbiter of bus_number, opening the bus once """
+    with _lock:
+        bus_arbiter = _arbiters.get(bus_number)
+        if bus_arbiter is None:
+            logger.info('Opening I2C bus %d' % bus_number)
+            _buses[bus_number] = SMBus(bus_number)
+            bus_arbiter = arbiter.BusArbiter(_buses[bus_number], bus_number)
+            _arbiters[bus_number] = bus_arbiter
+        return bus_arbiter
+
+
+def get_health(bus_number=1):
+    """ Return the shared BusHealth monitor of bus_number """
+    with _lock:
+        health = _healths.get(bus_number)
+        if health is None:
+            health = _healths[bus_number] = BusHealth(bus_number)
+        return health
+
+
+def get_bus(bus_number=1, priority=arbiter.PRIORITY_DEFAULT):
+    """ Return an SMBus look-alike for bus_number whose transactions run at priority """
+    return get_arbiter(bus_number).view(priority)
+
+
+def get_pwm(bus_number=1, address=0x40, frequency=None):
+    """ Return the shared, set up PCA9685 at (bus_number, address)
+
+        If frequency is given it is applied the first time it is requested,
+        see request_frequency().
+    """
+    key = (bus_number, address)
+    with _lock:
+        pwm = _pwms.get(key)
+        if pwm is None:
+            logger.info('Initialising PCA9685 0x%02X on bus %d' % (address, bus_number))
+            pwm = PWM(bus_number=bus_number, address=address,
+                      bus=get_bus(bus_number, arbiter.PRIORITY_ACTUATOR), health=get_health(bus_number))
+            pwm.setup()
+            _pwms[key] = pwm
+        if frequency is not None:
+            request_frequency(pwm, frequency)
+        return pwm
+
+
+def request_frequency(pwm, frequency, force=False):
+    """ Apply frequency to a shared PCA9685 once and return the active value
+
+        A later request for a different frequency is a conflict: the prescaler
+        is shared by all 16 channels, so it is logged, recorded in conflicts()
+        and ignored unless force is set.
+    """
+    key = (pwm.bus_number, pwm.address)
+    with _lock:
+        active = _frequencies.get(key)
+        if active == frequency:
+            return active
+        if active is not None and not force:
+            logger.warning('PCA9685 0x%02X on bus %d already runs at %d Hz, ignoring request for %d Hz'
+                           % (pwm.address, pwm.bus_number, active, frequency))
+            _conflicts.append((key, active, frequency))
+            return active
+        pwm.frequency = frequency
+        _frequencies[key] = frequency
+        return frequency
+
+
+def conflicts():
+    """ List of ((bus_number, address), active, requested) frequency conflicts """
+    with _lock:
+        return list(_conflicts)
+
+
+def close_all():
+    """ Stop the arbiters, close every shared bus handle and forget all devices """
+    with _lock:
+        for bus_arbiter in _arbiters.values():
+            bus_arbiter.stop()
+        for bus in _buses.values():
+            bus.close()
+        _arbiters.clear()
+        _buses.clear()
+        _healths.clear()
+        _pwms.clear()
+        _frequencies.clear()
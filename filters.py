@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Filters for ultrasonic distance readings.
+
+A FilterChain runs every reading through a list of stages. A stage
+either passes a (possibly smoothed) value on or drops the reading by
+returning None, so a missed echo (-1) or a stray reflection never
+reaches the obstacle code. Stages keep their history in fixed-size ring
+buffers. FilterChain.batch() runs the same chain over a whole recording
+with numpy for offline analysis; stages without a vectorised form are
+stepped through per value.
+
+    chain = FilterChain(DropInvalid(), RangeGate(2, 400), Median(5), EMA(0.5))
+    distance = chain.update(raw, time.monotonic())
+"""
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # only batch() needs it
+    np = None
+
+
+class RingBuffer(object):
+    """ The last size floats, oldest first """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = array('d', bytes(8 * size))
+        self._next = 0
+        self.count = 0
+
+    def push(self, value):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def values(self):
+        if self.count < self.size:
+            return self._data[:self.count].tolist()
+        return (self._data[self._next:] + self._data[:self._next]).tolist()
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+
+class DropInvalid(object):
+    """ Drops timeouts and other negative readings """
+
+    def update(self, value, timestamp=None):
+        return value if value >= 0 else None
+
+    def reset(self):
+        pass
+
+    def batch(self, values, timestamps=None):
+        return np.where(values >= 0, values, np.nan)
+
+
+class RangeGate(object):
+    """ Drops readings outside [low, high] cm, the sensor's usable range """
+
+    def __init__(self, low=2, high=400):
+        self.low = low
+        self.high = high
+
+    def update(self, value, timestamp=None):
+        return value if self.low <= value <= self.high else None
+
+    def reset(self):
+        pass
+
+    def batch(self, values, timestamps=None):
+        return np.where((values >= self.low) & (values <= self.high), values, np.nan)
+
+
+class Median(object):
+    """ Median of the last n readings that got this far """
+
+    def __init__(self, n=5):
+        self.n = n
+        self._buffer = RingBuffer(n)
+
+    def update(self, value, timestamp=None):
+        self._buffer.push(value)
+        values = sorted(self._buffer.values())
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
+
+    def reset(self):
+        self._buffer.clear()
+
+    def batch(self, values, timestamps=None):
+        out = np.full(len(values), np.nan)
+        valid = np.flatnonzero(~np.isnan(values))
+        compact = values[valid]
+        medians = np.empty(len(compact))
+        head = min(self.n - 1, len(compact))
+        for i in range(head):
+            medians[i] = np.median(compact[:i + 1])
+        if len(compact) >= self.n:
+            windows = np.lib.stride_tricks.sliding_window_view(compact, self.n)
+            medians[self.n - 1:] = np.median(windows, axis=1)
+        out[valid] = medians
+        return out
+
+
+class EMA(object):
+    """ Exponential moving average, alpha is the weight of a new reading """
+
+    def __init__(self, alpha=0.5):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value, timestamp=None):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class AlphaBeta(object):
+    """ Alpha-beta tracker of distance and closing speed
+
+        period is the assumed time between readings when no timestamps are
+        given. velocity is in cm/s, negative while approaching.
+    """
+
+    def __init__(self, alpha=0.5, beta=0.1, period=0.05):
+        self.alpha = alpha
+        self.beta = beta
+        self.period = period
+        self.reset()
+
+    def update(self, value, timestamp=None):
+        if self.value is None:
+            self.value = value
+            self._timestamp = timestamp
+            return value
+        dt = self.period
+        if timestamp is not None and self._timestamp is not None and timestamp > self._timestamp:
+            dt = timestamp - self._timestamp
+        self._timestamp = timestamp
+        predicted = self.value + self.velocity * dt
+        residual = value - predicted
+        self.value = predicted + self.alpha * residual
+        self.velocity += self.beta * residual / dt
+        return self.value
+
+    def reset(self):
+        self.value = None
+        self.velocity = 0.0
+        self._timestamp = None
+
+
+class FilterChain(object):
+    """ Runs readings through stages in order """
+
+    def __init__(self, *stages):
+        self.stages = list(stages)
+        self.accepted = 0
+        self.dropped = 0
+
+    def update(self, value, timestamp=None):
+        """ Filtered value, or None if a stage dropped the reading """
+        for stage in self.stages:
+            value = stage.update(value, timestamp)
+            if value is None:
+                self.dropped += 1
+                return None
+        self.accepted += 1
+        return value
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def batch(self, values, timestamps=None):
+        """ Filter a whole recording, dropped readings come back as NaN
+
+            Runs on fresh stage state and resets the stages afterwards, so
+            it does not disturb a live chain much beyond losing its history.
+        """
+        if np is None:
+            raise ImportError('FilterChain.batch() needs numpy')
+        values = np.asarray(values, dtype=float)
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=float)
+        self.reset()
+        for stage in self.stages:
+            if hasattr(stage, 'batch'):
+                values = stage.batch(values, timestamps)
+                continue
+            out = np.full(len(values), np.nan)
+            for i in np.flatnonzero(~np.isnan(values)):
+                result = stage.update(values[i], None if timestamps is None else timestamps[i])
+                if result is not None:
+                    out[i] = result
+            values = out
+        self.reset()
+        return values
+
+
+def default_chain(median=5):
+    """ Drop timeouts and out of range echoes, median of median readings, light EMA """
+    return FilterChain(DropInvalid(), RangeGate(2, 400), Median(median), EMA(0.5))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Lazy construction of the car's hardware objects.
+
+Driver scripts register a builder per device and get a proxy back; the
+device is only built when the proxy is first used, so the scripts can be
+imported (by tests, tooling or each other) without touching I2C or GPIO.
+Devices that do not depend on each other can be built in parallel with
+init(), and every build is timed for the startup report.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Hardware(object):
+    """ Registry of named, lazily built hardware objects """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._builders = {}
+        self._objects = {}
+        self._build_locks = {}
+        self._timings = {}
+        self._created = time.perf_counter()
+
+    def register(self, name, builder):
+        """ Register builder (a callable without arguments) under name
+
+            A later registration replaces an earlier one as long as the
+            object has not been built yet.
+        """
+        with self._lock:
+            if name in self._objects:
+                raise RuntimeError('"%s" is already built, it can not be re-registered' % name)
+            self._builders[name] = builder
+            self._build_locks.setdefault(name, threading.Lock())
+
+    def lazy(self, name):
+        """ Proxy that builds name on first attribute access """
+        return LazyDevice(self, name)
+
+    def get(self, name):
+        """ Return the object registered as name, building it if needed """
+        obj = self._objects.get(name)
+        if obj is not None:
+            return obj
+        try:
+            build_lock = self._build_locks[name]
+        except KeyError:
+            raise KeyError('No hardware registered as "%s"' % name)
+        with build_lock:
+            obj = self._objects.get(name)
+            if obj is None:
+                start = time.perf_counter()
+                obj = self._builders[name]()
+                end = time.perf_counter()
+                self._timings[name] = (start - self._created, end - start, threading.current_thread().name)
+                self.logger.info('Built "%s" in %.1f ms' % (name, (end - start) * 1000))
+                with self._lock:
+                    self._objects[name] = obj
+        return obj
+
+    def is_built(self, name):
+        return name in self._objects
+
+    def init(self, *names, parallel=True):
+        """ Build the given (independent) devices, all registered ones by default
+
+            With parallel set every device is built in its own thread, so
+            their I2C/GPIO set up and settle delays overlap.
+        """
+        names = names or tuple(self._builders)
+        start = time.perf_counter()
+        if parallel and len(names) > 1:
+            with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='hw-init') as pool:
+                for future in [pool.submit(self.get, name) for name in names]:
+                    future.result()
+        else:
+            for name in names:
+                self.get(name)
+        self._timings['<init>'] = (start - self._created, time.perf_counter() - start,
+                                   threading.current_thread().name)
+        return [self._objects[name] for name in names]
+
+    def startup_report(self):
+        """ Human readable table of when and how long every device took to build """
+        lines = ['%-12s %10s %10s  %s' % ('device', 'start ms', 'took ms', 'thread')]
+        for name, (offset, took, thread) in sorted(self._timings.items(), key=lambda item: item[1][0]):
+            lines.append('%-12s %10.1f %10.1f  %s' % (name, offset * 1000, took * 1000, thread))
+        return '\n'.join(lines)
+
+
+class LazyDevice(object):
+    """ Stand-in that forwards everything to the real device once built """
+
+    def __init__(self, hardware, name):
+        object.__setattr__(self, '_hardware', hardware)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_obj', None)
+
+    def _resolve(self):
+        obj = object.__getattribute__(self, '_obj')
+        if obj is None:
+            obj = object.__getattribute__(self, '_hardware').get(object.__getattribute__(self, '_name'))
+            object.__setattr__(self, '_obj', obj)
+        return obj
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._resolve(), attr, value)
+
+    def __repr__(self):
+        obj = object.__getattribute__(self, '_obj')
+        name = object.__getattribute__(self, '_name')
+        if obj is None:
+            return '<LazyDevice "%s" (not built)>' % name
+        return '<LazyDevice "%s" -> %r>' % (name, obj)
+
+
+# Process-wide default so every driver script shares the same devices
+car = Hardware()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+I2C fault handling and bus health monitoring.
+
+A failed transaction is retried a few times with a short, bounded
+exponential backoff (a transient NACK costs a few hundred microseconds).
+Per address error counters feed a circuit breaker: after too many failed
+transactions in a row the address is considered down and calls fail
+fast until a trial transaction succeeds again. Slow diagnostics (e.g.
+running i2cdetect) are run on a background thread, at most one at a time.
+"""
+import logging
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(IOError):
+    """ The address failed too often, the transaction was not attempted """
+
+
+class _Breaker(object):
+    """ Counters and circuit breaker state of one address """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.transactions = 0
+        self.errors = 0
+        self.retries = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+
+class BusHealth(object):
+    """ Retries, error counters and circuit breakers for the devices of one bus """
+
+    def __init__(self, bus_number=1, retries=3, backoff=0.0001, max_backoff=0.002,
+                 failure_threshold=5, reset_timeout=1.0, diagnose_interval=5.0):
+        self.logger = logging.getLogger(__name__)
+        self.bus_number = bus_number
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.diagnose_interval = diagnose_interval
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._diagnostics = None
+        self._last_diagnose = 0.0
+
+    def _breaker(self, address):
+        breaker = self._breakers.get(address)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(address, _Breaker())
+        return breaker
+
+    def execute(self, address, func, *args, diagnose=None):
+        """ Run func(*args) for the device at address with retries
+
+            Raises the last error once the retries are used up, or
+            CircuitOpenError without touching the bus while the circuit of
+            address is open. diagnose, a callable without arguments, is
+            started in the background after a failed transaction.
+        """
+        breaker = self._breaker(address)
+        if breaker.state == OPEN:
+            if time.monotonic() - breaker.opened_at < self.reset_timeout:
+                raise CircuitOpenError('I2C device 0x%02X on bus %d is down' % (address, self.bus_number))
+            with self._lock:
+                breaker.state = HALF_OPEN
+        breaker.transactions += 1
+        delay = self.backoff
+        # half open: a single trial, no retries
+        attempts = 1 if breaker.state == HALF_OPEN else self.retries + 1
+        for attempt in range(attempts):
+            try:
+                result = func(*args)
+            except Exception:
+                breaker.errors += 1
+                if attempt + 1 == attempts:
+                    self._failed(address, breaker, diagnose)
+                    raise
+                breaker.retries += 1
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                if breaker.consecutive_failures or breaker.state != CLOSED:
+                    with self._lock:
+                        if breaker.state != CLOSED:
+                            self.logger.warning('I2C device 0x%02X on bus %d is back', address, self.bus_number)
+                        breaker.state = CLOSED
+                        breaker.consecutive_failures = 0
+                return result
+
+    def _failed(self, address, breaker, diagnose):
+        with self._lock:
+            breaker.failures += 1
+            breaker.consecutive_failures += 1
+            if breaker.state == HALF_OPEN or breaker.consecutive_failures >= self.failure_threshold:
+                if breaker.state != OPEN:
+                    self.logger.error('I2C device 0x%02X on bus %d failed %d times in a row, opening circuit',
+                                      address, self.bus_number, breaker.consecutive_failures)
+                breaker.state = OPEN
+                breaker.opened_at = time.monotonic()
+        if diagnose is not None:
+            self.diagnose(diagnose)
+
+    def diagnose(self, func):
+        """ Run func on a background thread unless a diagnosis is running or ran recently """
+        with self._lock:
+            now = time.monotonic()
+            if self._diagnostics is not None and self._diagnostics.is_alive():
+                return False
+            if now - self._last_diagnose < self.diagnose_interval:
+                return False
+            self._last_diagnose = now
+            self._diagnostics = threading.Thread(target=self._run_diagnose, args=(func,),
+                                                 name='i2c-%d-diagnose' % self.bus_number, daemon=True)
+            self._diagnostics.start()
+        return True
+
+    def _run_diagnose(self, func):
+        try:
+            func()
+        except Exception:
+            self.logger.exception('I2C diagnosis failed')
+
+    def state(self, address):
+        return self._breaker(address).state
+
+    def reset(self, address=None):
+        """ Close the circuit of address (all addresses by default) """
+        with self._lock:
+            for key, breaker in self._breakers.items():
+                if address is None or key == address:
+                    breaker.state = CLOSED
+                    breaker.consecutive_failures = 0
+
+    def stats(self):
+        """ Per address counters, error rate and circuit state """
+        with self._lock:
+            return dict((address, {
+                'state': breaker.state,
+                'transactions': breaker.transactions,
+                'errors': breaker.errors,
+                'retries': breaker.retries,
+                'failures': breaker.failures,
+                'error_rate': float(breaker.failures) / breaker.transactions if breaker.transactions else 0.0,
+            }) for address, breaker in self._breakers.items())
@@ -17,6 +17,8 @@ import picar
 
 REFERENCES = [170, 170, 170, 170, 170]
 calibrate = False #True
+# follow lighting changes, REFERENCES are only the starting point
+adaptive_references = True
 forward_speedLeft = 30
 forward_speedRight = 30
 backward_speedLeft = 30
@@ -26,19 +28,70 @@ fast_speed = 70
 
 #turning_angle = 40
 
-logging.basicConfig(format='[%(asctime)s][%(module)s:%(funcName)s:%(lineno)d|%(levelname)s] -> %(message)s',
-                    level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-bw = picar.Backwheels(db='config.json')
-lf = picar.Linefollower(references=REFERENCES)
+# Shares the lazily built devices registered by obstacleAvoidance
+hw = picar.hardware.car
+hw.register('lf', lambda: picar.Linefollower(references=REFERENCES))
+ua = hw.lazy('ua')
+bw = hw.lazy('bw')
+lf = hw.lazy('lf')
+motors = hw.lazy('motors')
 
-max_off_track_count = 10
+# off the line for longer than this starts the recovery, about what the
+# old 10 loop passes took; shorter and a single bad frame at a junction
+# would back the car up
+max_off_track_time = 0.1
 max_on_track_count = 300
 
-delay = 0.0005
+sample_rate = 200
 
-bw.ready()
+# control loop tasks and their periods in seconds, see picar.scheduler
+line_period = 1.0 / sample_rate
+obstacle_period = 0.05
+telemetry_period = 5.0
+scheduler = picar.scheduler.Scheduler()
+
+# the loop has to come round within watchdog_timeout, obstacle avoidance
+# gets its own, longer time budget
+watchdog_timeout = 0.5
+avoidance_budget = 20
+# longest the recovery backs up looking for the line, and its pauses
+recovery_budget = 3
+recovery_pause = 0.2
+watchdog = picar.Watchdog(watchdog_timeout, lambda: motors.emergency_stop(), name='line_follower')
+
+# calculate possible speed factors for proper turning (you might want to adjust those)
+a_step = 0.9
+b_step = 0.7
+c_step = 0.5
+# frame code -> wheel speeds and direction memory, see picar.steering
+steering_table = picar.steering.SteeringTable.generate(base_speed, forward_speedLeft, forward_speedRight,
+                                                       steps=(a_step, b_step, c_step))
+
+# analog line position + PID instead of the table, fast enough for fast_speed
+use_pid = True
+pid_speed = fast_speed
+steering_pid = picar.pid.PID(kp=0.9, ki=0.3, kd=0.06, derivative_tau=0.02)
+# a longer gap between two PID updates (obstacle avoidance, a stalled
+# sensor ...) restarts the PID instead of integrating over the gap
+max_pid_gap = 0.1
+
+def startup():
+    # the three devices are independent, build them side by side
+    hw.init('bw', 'ua', 'lf')
+    logger.info('Startup:\n%s' % hw.startup_report())
+    # obstacle checks read the distance it keeps up to date, pinging only
+    # as far as they look makes it ping faster. Forked before the motor,
+    # sampler and bus threads run, so no lock of theirs is held in the child
+    ua.set_range(oa.close_range)
+    ua.start_measurement_process()
+    bw.ready()
+    motors.start()
+    if adaptive_references:
+        lf.track_references()
+    lf.start_sampler(sample_rate)
+    watchdog.start()
 
 def straight_run():
     while True:
@@ -50,130 +103,177 @@ def setup():
     if calibrate:
         cali()
 
-def main():
-    #global turning_angle
-    off_track_count = 0 # experimental value
-    on_track_count = 0
-    # True just have turned right , False just have turned left
-    last_forward_direction = 0
-    last_backward_direction = 0
-    bw.speedLeft = forward_speedLeft
-    bw.speedRight = forward_speedRight
-    count = 0
-    # calculate possible speed factors for proper turning (you might want to adjust those)
-    a_step = 0.9
-    b_step = 0.7
-    c_step = 0.5
-    d_step = 0.3
-    e_step = 0.1
-
-    #bw.forward()
-    while True:
-        oa.check_obstacle('s')
-        lt_status_now = lf.read_digital()
-        logging.info(lt_status_now)
-
-        # Angle calculate
-        if  lt_status_now == [0,0,1,0,0]:
-            step = 1
-        elif lt_status_now == [0,1,1,0,0] or lt_status_now == [0,0,1,1,0]:
-            step = a_step
-        elif lt_status_now == [0,1,0,0,0] or lt_status_now == [0,0,0,1,0] :
-            step = b_step
-        elif lt_status_now == [1,1,0,0,0] or lt_status_now == [0,0,0,1,1] or lt_status_now == [1,0,0,0,0] or lt_status_now == [0,0,0,0,1]:
-            step = c_step
-        elif lt_status_now == [1,1,1,0,0] or lt_status_now == [0,0,1,1,1] or lt_status_now == [1,1,1,1,0] or lt_status_now == [0,1,1,1,1]:
-            step = d_step
-        elif lt_status_now == [1,1,1,1,1]:
-            step = 1
-
-        # Direction calculate
-        if  lt_status_now in ([0,0,1,0,0]):
-            off_track_count = 0
-            on_track_count = 0
-            last_forward_direction = 0
-            # same speed for both wheels
-            bw.left_wheel.speed = base_speed
-            bw.right_wheel.speed = base_speed
-            bw.forward()
-
-        # turn right
-        elif lt_status_now in ([0,0,1,1,0], [0,0,0,1,0], [0,0,0,1,1], [0,0,0,0,1]):
-            off_track_count = 0
-            on_track_count = 0
-            count = 0
-            last_forward_direction = 2
-            bw.left_wheel.speed = int(forward_speedLeft * step)
-            bw.right_wheel.speed = int(forward_speedRight)
-            bw.forward()
-
-        elif lt_status_now in ([0,0,1,1,1], [0,1,1,1,1]):
-            off_track_count = 0
-            on_track_count = 0
-            last_forward_direction = 2
-            bw.left_wheel.speed = int(forward_speedRight)
-            bw.right_wheel.speed = int(forward_speedRight)
-            bw.forward()
-
-        # turn left
-        elif lt_status_now in ([0,1,1,0,0], [0,1,0,0,0], [1,1,0,0,0], [1,0,0,0,0]):
-            off_track_count = 0
-            on_track_count = 0
-            count = 0
-            last_forward_direction = 1
-            bw.left_wheel.speed = int(forward_speedLeft)
-            bw.right_wheel.speed = int(forward_speedRight * step)
-            bw.forward()
-
-        elif lt_status_now in ([1,1,1,0,0], [1,1,1,1,0]):
-            off_track_count = 0
-            on_track_count = 0
-            last_forward_direction = 1
-            bw.left_wheel.speed = int(forward_speedLeft)
-            bw.right_wheel.speed = int(forward_speedLeft)
-            bw.forward()
-
-        elif lt_status_now == [0,0,0,0,0]:
-            off_track_count += 1
-            if off_track_count > max_off_track_count:
-                # make sure picar drives in a curve backwards
-                if last_forward_direction == 0:
-                    bw.left_wheel.speed = base_speed
-                    bw.right_wheel.speed = base_speed
-                    bw.backward()
-
-                    lf.wait_tile_center()
-                    bw.stop()
-
-                if last_forward_direction == 1:
-                    bw.left_wheel.speed = int(base_speed*0.1)
-                    bw.right_wheel.speed = base_speed
-                    bw.backward()
-
-                    lf.wait_tile_center()
-                    bw.stop()
-                    last_backward_direction = 2
-
-                if last_forward_direction == 2:
-                    bw.left_wheel.speed = base_speed
-                    bw.right_wheel.speed = int(base_speed*0.1)
-                    bw.backward()
-
-                    lf.wait_tile_center()
-                    bw.stop()
-                    last_backward_direction = 1
-
-                # fw.turn(turning_angle)
-                time.sleep(0.2)
-                bw.left_wheel.speed = base_speed
-                bw.right_wheel.speed = base_speed
-                bw.forward()
-                time.sleep(0.2)
+class LineControl(object):
+    """ State shared by both line control tasks
+
+        The off track recovery is a state of the task as well: every step
+        moves it on instead of blocking the scheduler, and with it the
+        obstacle task, until the line is found again.
+    """
+
+    def __init__(self):
+        # when the line was lost, None while on track
+        self.off_track_since = None
+        # 0 straight, 1 left, 2 right, see picar.steering
+        self.last_forward_direction = 0
+        # (phase, scheduler time it started) while recovering, else None
+        self.recovery = None
+        self.last_sequence = None
 
+    def next_frame(self):
+        """ The sampler's frame if it is new since the last step, else None """
+        frame = lf.latest_frame()
+        if frame is None:
+            # no usable sensor reading, hold still until it comes back
+            self.hold()
+            return None
+        if frame.sequence == self.last_sequence:
+            # the sampler has nothing new yet
+            return None
+        self.last_sequence = frame.sequence
+        return frame
+
+    def hold(self):
+        motors.halt()
+        self.recovery = None
+
+    def on_track(self):
+        self.off_track_since = None
+
+    def off_track(self):
+        """ Start the recovery once off track for max_off_track_time, True if it started """
+        now = scheduler.now()
+        if self.off_track_since is None:
+            self.off_track_since = now
+        elif now - self.off_track_since > max_off_track_time:
+            self.off_track_since = None
+            self.start_recovery(now)
+            return True
+        return False
+
+    def start_recovery(self, now):
+        # back up in a curve, towards where the line was seen last
+        if self.last_forward_direction == 1:
+            motors.drive(-base_speed*0.1, -base_speed)
+        elif self.last_forward_direction == 2:
+            motors.drive(-base_speed, -base_speed*0.1)
         else:
-            off_track_count = 0
+            motors.drive(-base_speed, -base_speed)
+        self.recovery = ('backing', now)
+
+    def recovering(self, frame):
+        """ Move the recovery on by one frame, False once it is over
+
+            Backs up until the middle sensor finds the line again (at most
+            recovery_budget seconds), stops, then drives off straight.
+        """
+        phase, since = self.recovery
+        now = scheduler.now()
+        if phase == 'backing':
+            if frame.digital[2] == 1 or now - since > recovery_budget:
+                motors.halt()
+                self.recovery = ('stopped', now)
+        elif phase == 'stopped':
+            if now - since >= recovery_pause:
+                motors.drive(base_speed, base_speed)
+                self.recovery = ('leaving', now)
+        elif now - since >= recovery_pause:
+            self.recovery = None
+        return self.recovery is not None
+
+
+class TableControl(LineControl):
+    """ Line task steering from the frame code lookup table """
 
-        time.sleep(delay)
+    def step(self):
+        watchdog.feed()
+        frame = self.next_frame()
+        if frame is None or (self.recovery is not None and self.recovering(frame)):
+            return
+        logger.debug('Line status: %s', frame.digital)
+
+        # one lookup replaces the pattern comparisons; the table is read every
+        # step so it can be swapped while running
+        steer = steering_table[frame.code]
+        if not steer.off_track:
+            self.on_track()
+            if steer.direction is not None:
+                self.last_forward_direction = steer.direction
+            if steer.left is not None:
+                motors.drive(steer.left, steer.right)
+        else:
+            self.off_track()
+
+
+class PidControl(LineControl):
+    """ Line task following the analog line position with the PID """
+
+    def __init__(self):
+        super(PidControl, self).__init__()
+        self.controller = picar.pid.DifferentialSteering(motors, steering_pid, pid_speed)
+        self.controller.reset()
+        self.last_timestamp = None
+
+    def step(self):
+        watchdog.feed()
+        frame = self.next_frame()
+        if frame is None or (self.recovery is not None and self.recovering(frame)):
+            return
+        position = lf.line_position(frame.analog)
+
+        if position is not None:
+            self.on_track()
+            if position < -0.1:
+                self.last_forward_direction = 1
+            elif position > 0.1:
+                self.last_forward_direction = 2
+            else:
+                self.last_forward_direction = 0
+            dt = line_period if self.last_timestamp is None else frame.timestamp - self.last_timestamp
+            if dt > max_pid_gap:
+                self.controller.reset()
+                dt = line_period
+            self.controller.steer(position, dt)
+            self.last_timestamp = frame.timestamp
+        elif self.off_track():
+            self.reset()
+
+    def hold(self):
+        super(PidControl, self).hold()
+        self.reset()
+
+    def reset(self):
+        self.controller.reset()
+        self.last_timestamp = None
+
+
+def check_obstacle():
+    """ Obstacle task, the avoidance manoeuvre gets its own watchdog budget
+
+        Only looks at the measurement process' latest reading: pinging
+        here would hold up the line task on the same scheduler.
+    """
+    distance, timestamp = ua.latest_reading()
+    if time.monotonic() - timestamp > ua.MAX_AGE:
+        return
+    watchdog.feed(avoidance_budget)
+    oa.check_obstacle('s', distance)
+    watchdog.feed()
+
+def telemetry():
+    for name, stats in scheduler.stats().items():
+        logger.info('%s: %d runs, %d missed, %d overruns, late max %.1f ms, max %.1f ms'
+                    % (name, stats['runs'], stats['misses'], stats['overruns'],
+                       stats['late_max_ms'], stats['duration_max_ms']))
+
+def main():
+    """ Run line control, obstacle checks and telemetry at their own rates """
+    control = PidControl() if use_pid else TableControl()
+    scheduler.add('line', control.step, line_period)
+    # half a line period apart, so both do not always fall on the same release
+    scheduler.add('obstacle', check_obstacle, obstacle_period, offset=line_period / 2)
+    scheduler.add('telemetry', telemetry, telemetry_period, offset=telemetry_period)
+    scheduler.run()
 
 def cali():
     references = [0, 0, 0, 0, 0]
@@ -197,13 +297,28 @@ def cali():
     time.sleep(1)
 
 def destroy():
+    scheduler.stop()
+    watchdog.stop()
+    lf.stop_sampler()
+    ua.stop_measurement_process()
+    motors.stop()
     bw.stop()
+    logger.info('Motor control: %s' % motors.stats())
+    logger.info('Watchdog: %s' % watchdog.stats())
+    logger.info('Scheduler: %s' % scheduler.stats())
+    logger.info('Line sensor reads: %s' % lf.read_stats())
+    logger.info('Ultrasonic pings/s: %.1f' % ua.pings_per_second())
+    if lf.tracker is not None:
+        logger.info('References: %s' % lf.tracker.stats())
 
 if __name__ == '__main__':
+    # Console output goes through a queue listener thread, driver hot paths
+    # only log warnings (see picar.logconfig)
+    picar.logconfig.setup_logging(level=logging.INFO)
     try:
-        while True:
-            #setup()
-            main()
+        startup()
+        #setup()
+        main()
     except Exception as e:
         logger.exception("Error ...!")
         destroy()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Logging set up for the driver scripts.
+
+setup_logging() replaces the scripts' logging.basicConfig(level=DEBUG):
+records are put on a queue by the control thread and formatted and
+written to the console/file by a QueueListener thread, and the loggers
+of the per-transaction driver modules are held at hot_path_level so
+their (lazy, level guarded) debug calls cost next to nothing. Call it
+from a script's __main__, not at import time: it starts the listener
+thread.
+
+The queue pays off while the hot paths are quiet. With everything at
+DEBUG every record still crosses it and the listener competes for the
+GIL; that is slower than plain logging (0.7-0.8x in the benchmark), so
+use queued=False for such debugging sessions.
+
+Forked processes (the UHead measurement process) have no listener
+thread, they write their records straight to the listener's handlers.
+
+Run "python -m picar.logconfig" for a loop rate benchmark of both modes.
+"""
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+
+FORMAT = '[%(asctime)s][%(module)s:%(funcName)s:%(lineno)d|%(levelname)s] -> %(message)s'
+
+# Modules that log on every I2C transaction / motor or servo command
+HOT_PATH_LOGGERS = ('picar.PCA9685', 'picar.TB6612', 'picar.Servo', 'picar.Backwheels',
+                    'picar.UHead', 'picar.Linefollower', 'picar.arbiter')
+
+_listener = None
+_handler = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that leaves formatting to the listener thread
+
+        The stock prepare() runs the whole Formatter on the logging thread;
+        here only msg % args is merged right away, like getMessage() in the
+        stock one, so mutable args (lists of readings ...) are logged as
+        they were. Records with exception info are prepared in full, their
+        traceback can not safely cross threads unformatted.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            return super(DeferredQueueHandler, self).prepare(record)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level=logging.INFO, hot_path_level=logging.WARNING, filename=None, console=True, queued=True):
+    """ Configure the root logger once per process and return the QueueListener (or None)
+
+        Calling it again only updates the levels.
+    """
+    global _listener, _handler
+    root = logging.getLogger()
+    root.setLevel(level)
+    for name in HOT_PATH_LOGGERS:
+        logging.getLogger(name).setLevel(hot_path_level)
+    if _listener is not None or (root.handlers and not queued):
+        return _listener
+
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler()] if console else []
+    if filename is not None:
+        handlers.append(logging.FileHandler(filename))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    if not queued:
+        for handler in handlers:
+            root.addHandler(handler)
+        return None
+
+    records = queue.SimpleQueue()
+    _handler = DeferredQueueHandler(records)
+    root.addHandler(_handler)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """ Flush the queue, stop the listener thread and detach the queue handler """
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _after_fork():
+    # the listener thread stays behind in the parent, nothing would drain
+    # the child's copy of the queue
+    global _listener, _handler
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = None
+    _handler = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _benchmark(iterations=20000):
+    """ Loop rate of a simulated control loop under eager DEBUG vs. hot path mode """
+    import os
+    import tempfile
+    import time
+
+    pwm_logger = logging.getLogger('picar.PCA9685')
+    motor_logger = logging.getLogger('picar.TB6612')
+    loop_logger = logging.getLogger('line_follower')
+
+    def eager_iteration(i):
+        # what one line_follower iteration used to log: 2 motors x (speed + 1 block) + frame
+        for channel in (4, 5):
+            motor_logger.info('Set speed to: %s' % i)
+            pwm_logger.info('Set channel "%d" to value "%d"' % (channel, i))
+            pwm_logger.info('Writing block %s to %2X' % (' '.join('%02X' % d for d in [0, 0, i & 0xFF, 0]), 6))
+        loop_logger.info([0, 0, 1, 0, 0])
+
+    def lazy_iteration(i):
+        for channel in (4, 5):
+            motor_logger.debug('Set speed to: %s', i)
+            pwm_logger.debug('Set channel "%d" to value "%d"', channel, i)
+            if pwm_logger.isEnabledFor(logging.DEBUG):
+                pwm_logger.debug('Writing block %s to %2X', ' '.join('%02X' % d for d in [0, 0, i & 0xFF, 0]), 6)
+        loop_logger.debug('Line status: %s', [0, 0, 1, 0, 0])
+
+    def run(iteration):
+        start = time.perf_counter()
+        for i in range(iterations):
+            iteration(i)
+        return iterations / (time.perf_counter() - start)
+
+    root = logging.getLogger()
+    fd, path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    results = []
+    try:
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        for name in HOT_PATH_LOGGERS:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        results.append(('basicConfig DEBUG, eager', run(eager_iteration)))
+        root.removeHandler(handler)
+        handler.close()
+
+        setup_logging(level=logging.INFO, filename=path, console=False)
+        results.append(('queued, hot path WARNING', run(lazy_iteration)))
+        setup_logging(level=logging.DEBUG, hot_path_level=logging.DEBUG)
+        results.append(('queued, everything DEBUG', run(lazy_iteration)))
+        stop_logging()
+    finally:
+        os.remove(path)
+    for name, rate in results:
+        print('%-28s %10.0f loops/s  (x%.1f)' % (name, rate, rate / results[0][1]))
+
+
+if __name__ == '__main__':
+    _benchmark()
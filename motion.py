@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Ramped wheel speeds.
+
+MotorController owns the back wheels: callers only set target speeds
+(drive() returns immediately) and a thread moves each wheel's command
+towards its target at a fixed rate, limited to max_accel percent per
+second and changing that acceleration by at most max_jerk percent per
+second squared. Wheels no longer jump from 0 to 60 %, which saves the
+tyres from slipping and the battery from current spikes, and turns come
+out the same every time.
+
+A steering loop uses steer() instead: only its base speed is ramped
+(launch, stop, speed changes), the left/right split reaches the wheels
+right away, so the loop does not see the ramp as actuator lag.
+"""
+import logging
+import math
+import threading
+import time
+
+
+class _Ramp(object):
+    """ Speed and acceleration of one wheel on its way to the target """
+
+    def __init__(self):
+        self.target = 0.0
+        self.speed = 0.0
+        self.accel = 0.0
+
+    def step(self, dt, max_accel, max_jerk):
+        error = self.target - self.speed
+        if not error:
+            self.accel = 0.0
+            return self.speed
+        direction = 1.0 if error > 0 else -1.0
+        if max_jerk:
+            # the highest acceleration that can still be ramped down to 0 by
+            # the time the target is reached, so the speed does not overshoot
+            wanted = direction * min(max_accel, math.sqrt(2 * max_jerk * abs(error)))
+            change = max(-max_jerk * dt, min(max_jerk * dt, wanted - self.accel))
+            self.accel += change
+        else:
+            self.accel = direction * max_accel
+        speed = self.speed + self.accel * dt
+        if (self.target - speed) * direction <= 0:
+            speed = self.target
+            self.accel = 0.0
+        self.speed = speed
+        return speed
+
+    def reset(self, speed):
+        self.target = self.speed = speed
+        self.accel = 0.0
+
+
+class MotorController(object):
+    """ Drives Backwheels towards target speeds under acceleration and jerk limits
+
+        max_accel is in percent per second, max_jerk in percent per second
+        squared (None for a plain acceleration ramp).
+    """
+
+    def __init__(self, backwheels, rate=100, max_accel=400.0, max_jerk=4000.0):
+        self.logger = logging.getLogger(__name__)
+        self.backwheels = backwheels
+        self.rate = rate
+        self.max_accel = max_accel
+        self.max_jerk = max_jerk
+        self._left = _Ramp()
+        self._right = _Ramp()
+        # base speed and (left, right) scales after steer(), None after drive()
+        self._base = _Ramp()
+        self._scales = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        # set by emergency_stop() without the lock, cleared by the next drive()
+        self._halted = False
+        self.ticks = 0
+        self.overruns = 0
+        self.max_lag = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='motor-control', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the control thread, the wheels keep their last command """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def drive(self, left, right):
+        """ Set signed target speeds (-100..100) and return right away
+
+            Same arguments as Backwheels.drive(), so the controller can stand
+            in for the back wheels. Starts the control thread if needed.
+        """
+        if not (-100 <= left <= 100 and -100 <= right <= 100):
+            raise ValueError('speeds range from -100 to 100, not "{0}", "{1}"'.format(left, right))
+        with self._lock:
+            self._left.target = left
+            self._right.target = right
+            self._scales = None
+            self._halted = False
+        if not self.running:
+            self.start()
+
+    set_target = drive
+
+    def steer(self, speed, left_scale=1.0, right_scale=1.0):
+        """ Drive the wheels at speed times left_scale and right_scale (-1..1)
+
+            Only speed is ramped. A change of the scales alone is written
+            right away, from the calling thread, once speed has been reached.
+            Starts the control thread if needed.
+        """
+        if not -100 <= speed <= 100:
+            raise ValueError('speed ranges from -100 to 100, not "{0}"'.format(speed))
+        if not (-1 <= left_scale <= 1 and -1 <= right_scale <= 1):
+            raise ValueError('scales range from -1 to 1, not "{0}", "{1}"'.format(left_scale, right_scale))
+        with self._lock:
+            if self._scales is None:
+                # coming from drive(), ramp on from the faster wheel
+                self._base.reset(max(self._left.speed, self._right.speed, key=abs))
+            self._base.target = speed
+            self._scales = (left_scale, right_scale)
+            self._halted = False
+            if self._base.speed == speed:
+                self._write_scaled(speed)
+        if not self.running:
+            self.start()
+
+    def halt(self):
+        """ Stop both wheels now, without a ramp """
+        with self._lock:
+            self._left.reset(0.0)
+            self._right.reset(0.0)
+            self._base.reset(0.0)
+            self._scales = None
+            self.backwheels.stop()
+
+    def emergency_stop(self):
+        """ Backwheels.emergency_stop() that the control thread will not undo
+
+            Does not wait for the lock, so it is safe from a watchdog even
+            while the control thread hangs. The ramps restart from 0 with
+            the next drive().
+        """
+        self._halted = True
+        self.backwheels.emergency_stop()
+
+    def reset(self, left=0.0, right=0.0):
+        """ Take left/right as the wheels' actual speeds after driving them directly """
+        with self._lock:
+            self._left.reset(left)
+            self._right.reset(right)
+            self._scales = None
+
+    def _lag(self):
+        if self._scales is not None:
+            error = self._base.target - self._base.speed
+            return error * self._scales[0], error * self._scales[1]
+        return self._left.target - self._left.speed, self._right.target - self._right.speed
+
+    def lag(self):
+        """ (left, right) target minus commanded speed right now """
+        with self._lock:
+            return self._lag()
+
+    def _write(self, left, right):
+        self.backwheels.drive(left, right)
+        if self._halted:
+            # emergency_stop() came in while this write was going out
+            self.backwheels.emergency_stop()
+
+    def _write_scaled(self, base):
+        left = base * self._scales[0]
+        right = base * self._scales[1]
+        if (left, right) != (self._left.speed, self._right.speed):
+            # the wheel ramps follow, a drive() afterwards ramps on from here
+            self._left.reset(left)
+            self._right.reset(right)
+            self._write(left, right)
+
+    def _tick(self, dt):
+        with self._lock:
+            if self._halted:
+                self._left.reset(0.0)
+                self._right.reset(0.0)
+                self._base.reset(0.0)
+                return
+            if self._scales is not None:
+                self._write_scaled(self._base.step(dt, self.max_accel, self.max_jerk))
+            else:
+                before = (self._left.speed, self._right.speed)
+                left = self._left.step(dt, self.max_accel, self.max_jerk)
+                right = self._right.step(dt, self.max_accel, self.max_jerk)
+                if (left, right) != before:
+                    self._write(left, right)
+            lag = max(abs(error) for error in self._lag())
+        self.ticks += 1
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_time = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                self._tick(period)
+            except Exception:
+                self.logger.exception('Motor control step failed')
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                self.overruns += 1
+                next_time = time.monotonic()
+
+    def stats(self):
+        left, right = self.lag()
+        return {'ticks': self.ticks,
+                'overruns': self.overruns,
+                'lag': (round(left, 1), round(right, 1)),
+                'max_lag': round(self.max_lag, 1)}
@@ -6,16 +6,22 @@ import logging
 
 import picar
 
-logging.basicConfig(format='[%(asctime)s][%(module)s:%(funcName)s:%(lineno)d|%(levelname)s] -> %(message)s',
-                    level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
 force_turning = 0  # 0 = random direction, 1 = force left, 2 = force right, 3 = orderdly
 
-ua = picar.UHead(db='config.json')
-bw = picar.Backwheels(db='config.json')
-lf = picar.Linefollower()
+# Hardware is built on first use (or by hw.init()), not at import time
+hw = picar.hardware.car
+hw.register('ua', lambda: picar.UHead(db='config.json'))
+hw.register('bw', lambda: picar.Backwheels(db='config.json'))
+hw.register('lf', lambda: picar.Linefollower())
+# all wheel commands go through the ramped motor controller
+hw.register('motors', lambda: picar.motion.MotorController(hw.get('bw')))
+ua = hw.lazy('ua')
+bw = hw.lazy('bw')
+lf = hw.lazy('lf')
+motors = hw.lazy('motors')
 
 last_angle = 90
 direction = ''
@@ -25,6 +31,11 @@ last_direction_index = 0
 
 LineSensorStatus = []
 
+# scan readings older than this count as occupied in getVision()
+scan_max_age = 1.0
+# farthest any of the checks below looks, pings beyond it are not waited for
+close_range = 30
+
 DEFAULT_REFERENCES = [150,150,150,150,150]
 calibriert = True
 """if calibriert == False:
@@ -32,26 +43,40 @@ calibriert = True
 else:
     references = DEFAULT_REFERENCES"""
 
-def check_obstacle(direction):
-    if direction == 'l':
-        ua.turn(180)
-    elif direction == 's':
-        ua.turn_straight()
-    elif direction == 'r':
-        ua.turn(0)
-
-    distance = ua.get_distance()
+def check_obstacle(direction, distance=None):
+    """ Avoid an obstacle closer than 7 cm in direction
+
+        distance is a reading the caller already has in that direction,
+        without one the head is turned there and pings.
+    """
+    angle = {'l': 180, 's': 90, 'r': 0}[direction]
+    scanning = ua.scanning
+    if distance is None and scanning:
+        # the head is sweeping anyway, use its latest reading in that direction
+        distance, timestamp = ua.scanned_distance(angle)
+        if distance < 0 or time.monotonic() - timestamp > scan_max_age:
+            # the sweep has not been there (lately), nothing to act on
+            return
+    elif distance is None:
+        ua.turn(angle)
+        # no ping before the head points where it should
+        ua.wait_settled()
+        distance = ua.get_distance(max_distance=close_range)
     # tu them
-    logger.info("distance: %scm" % distance)
-
-    if distance < 7:
-        bw.stop()
+    logger.debug("distance: %scm", distance)
+
+    # NO_READING (-1) is no echo, not an obstacle
+    if 0 <= distance < 7:
+        if scanning:
+            # the avoid_* routines turn the head themselves
+            ua.stop_scan()
+        motors.halt()
         avoid_obstacle(checkoutObstacle())
         time.sleep(1)
         ua.turn_straight()
-        bw.left_wheel.speed = 30
-        bw.right_wheel.speed = 30
-        bw.forward()
+        motors.drive(30, 30)
+        if scanning:
+            ua.start_scan()
 def checkoutObstacle():
     vision = getVision()
     logger.info("checkoutObstacle vision:")
@@ -104,26 +129,24 @@ def avoid_single(direction = 'r'):
     else:
         ua_direction = 0
 
-    distance = ua.get_distance()
+    distance = ua.get_distance(max_distance=close_range)
 
     while distance < 25:
-        distance = ua.get_distance()
-        bw.backward(40)
-    bw.stop()
+        distance = ua.get_distance(max_distance=close_range)
+        motors.drive(-40, -40)
+    motors.halt()
 
     ua.turn_straight()
-    bw.forward(20)
-
     if direction == 'l':
-        bw.left_wheel.speed = 60
+        motors.drive(60, 20)
     else:
-        bw.right_wheel.speed = 60
+        motors.drive(20, 60)
 
     lock = False
     frontClear = False
 
     while lock==frontClear:
-        distance = ua.get_distance()
+        distance = ua.get_distance(max_distance=close_range)
         if distance > 27:
             frontClear = True
             break
@@ -131,13 +154,12 @@ def avoid_single(direction = 'r'):
     ua.turn(ua_direction)
 
     while lock!=frontClear:
-        distance = ua.get_distance()
+        distance = ua.get_distance(max_distance=close_range)
         if distance < 20:
             lock = True
             break
 
-    bw.left_wheel.speed = 30
-    bw.right_wheel.speed =30
+    motors.drive(30, 30)
     #last_angle = rection
     wait_until_allWhite()
 
@@ -156,13 +178,13 @@ def avoid_double():
     leftClear = False
     rightClear = False
 
-    bw.forward(30)
+    motors.drive(30, 30)
     tunnel_passed = False
 
-    last_dist = ua.get_distance()
+    last_dist = ua.get_distance(max_distance=close_range)
     time.sleep(0.1)
 
-    dist = ua.get_distance()
+    dist = ua.get_distance(max_distance=close_range)
 
     while not tunnel_passed:
         vision = getVision(180, -90, -90, 13)
@@ -176,23 +198,21 @@ def avoid_double():
             else:
                 ua_direction = 0
 
-            distance = ua.get_distance()
+            distance = ua.get_distance(max_distance=close_range)
 
-            bw.stop()
+            motors.halt()
 
             ua.turn_straight()
-            bw.forward(20)
-
             if direction == 'l':
-                bw.left_wheel.speed = 60
+                motors.drive(60, 20)
             else:
-                bw.right_wheel.speed = 60
+                motors.drive(20, 60)
 
             lock = False
             frontClear = False
 
             while lock == frontClear:
-                distance = ua.get_distance()
+                distance = ua.get_distance(max_distance=close_range)
                 if distance > 27:
                     frontClear = True
                     break
@@ -200,13 +220,12 @@ def avoid_double():
             ua.turn(ua_direction)
 
             while lock != frontClear:
-                distance = ua.get_distance()
+                distance = ua.get_distance(max_distance=close_range)
                 if distance < 20:
                     lock = True
                     break
 
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 30
+            motors.drive(30, 30)
             # last_angle = rection
             wait_until_allWhite()
 
@@ -222,21 +241,19 @@ def avoid_double():
             else:
                 ua_direction = 0
 
-            bw.stop()
+            motors.halt()
 
             ua.turn_straight()
-            bw.forward(20)
-
             if direction == 'l':
-                bw.left_wheel.speed = 60
+                motors.drive(60, 20)
             else:
-                bw.right_wheel.speed = 60
+                motors.drive(20, 60)
 
             lock = False
             frontClear = False
 
             while lock == frontClear:
-                distance = ua.get_distance()
+                distance = ua.get_distance(max_distance=close_range)
                 if distance > 27:
                     frontClear = True
                     break
@@ -244,13 +261,12 @@ def avoid_double():
             ua.turn(ua_direction)
 
             while lock != frontClear:
-                distance = ua.get_distance()
+                distance = ua.get_distance(max_distance=close_range)
                 if distance < 20:
                     lock = True
                     break
 
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 30
+            motors.drive(30, 30)
             # last_angle = rection
             wait_until_allWhite()
 
@@ -259,18 +275,19 @@ def avoid_double():
                 keep_lock(direction)
                 ignore_offTrack(direction)
         else:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 30
-            bw.forward()
+            motors.drive(30, 30)
             time.sleep(0.5)
-            bw.stop()
+            motors.halt()
 
 def getVision(left= 150, right= -30, step= -60, radius = 8):
+    if ua.scanning:
+        # answered from the background scan's range map, no sweep needed
+        return ua.sectors(range(left, right, step), radius, max_age=scan_max_age)
     vision = []
     for i in range(left, right, step):
         ua.turn(i)
-        time.sleep(0.25)
-        vision.append(ua.get_distance() < radius)
+        ua.wait_settled()
+        vision.append(ua.get_distance(max_age=0, max_distance=close_range) < radius)
     ua.turn_straight()
     return vision
 
@@ -278,13 +295,11 @@ def ignore_offTrack(direction):
     LineSensorStatus = lf.read_digital()
     if direction == 'l':
         if 1 in LineSensorStatus[0:1]:
-            bw.left_wheel.speed = 50
-            bw.right_wheel.speed = 30
+            motors.drive(50, 30)
             wait_until_allWhite()
     else:
         if 1 in LineSensorStatus[-2:-1]:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 50
+            motors.drive(30, 50)
             wait_until_allWhite()
 
 def track_caught(direction) -> bool:
@@ -312,64 +327,49 @@ def keep_lock(direction):
     global last_angle
 
     if direction == 'r':
-        last_dist = ua.get_distance()
+        last_dist = ua.get_distance(max_distance=close_range)
         time.sleep(0.1)
 
-        dist = ua.get_distance()
+        dist = ua.get_distance(max_distance=close_range)
         if dist > 10:
 
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 20
-            bw.forward()
+            motors.drive(30, 20)
         elif dist < 7:
-            bw.left_wheel.speed = 20
-            bw.right_wheel.speed = 30
-            bw.forward()
+            motors.drive(20, 30)
         elif dist < last_dist:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 20
-            bw.forward()
+            motors.drive(30, 20)
         elif dist > last_dist:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 20
-            bw.forward()
+            motors.drive(30, 20)
         elif (dist == last_dist) and (dist < 10) and (last_dist < 10):
-            bw.right_wheel.speed = 30
-            bw.left_wheel.speed = 30
-            bw.forward()
+            motors.drive(30, 30)
 
     else:
-        last_dist = ua.get_distance()
+        last_dist = ua.get_distance(max_distance=close_range)
         time.sleep(0.1)
 
-        dist = ua.get_distance()
+        dist = ua.get_distance(max_distance=close_range)
         if dist > 10:
-            bw.left_wheel.speed = 20
-            bw.right_wheel.speed = 30
-            bw.forward()
+            motors.drive(20, 30)
         elif dist < 7:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 20
-            bw.forward()
+            motors.drive(30, 20)
         elif dist < last_dist:
-            bw.left_wheel.speed = 20
-            bw.right_wheel.speed = 30
-            bw.forward()
+            motors.drive(20, 30)
         elif dist > last_dist:
-            bw.left_wheel.speed = 30
-            bw.right_wheel.speed = 20
-            bw.forward()
+            motors.drive(30, 20)
         elif (dist == last_dist) and (dist < 10):
-            bw.right_wheel.speed = 30
-            bw.left_wheel.speed = 30
+            motors.drive(30, 30)
 def wait_until_allWhite():
-    while True in lf.read_digital():
-        time.sleep(0.1)
+    lf.wait_for(lambda status: 1 not in status)
 
 if __name__ == '__main__':
+    picar.logconfig.setup_logging(level=logging.INFO)
     try:
+        hw.init('ua', 'bw', 'lf')
+        logger.info('Startup:\n%s' % hw.startup_report())
+        ua.start_scan()
         while True:
-            getVision()
+            logger.info('Vision: %s' % getVision())
+            time.sleep(0.5)
     except Exception as e:
         logger.exception("Error..!")
     except KeyboardInterrupt:
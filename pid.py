@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+PID steering for the line follower.
+
+PID is a plain discrete controller with a clamped output, an integrator
+that stops accumulating while the output saturates (anti-windup) and a
+first-order low-pass on the derivative, which is taken on the
+measurement so setpoint changes do not kick the wheels.
+DifferentialSteering turns its output into left/right wheel speeds on
+Backwheels (or a MotorController, which ramps the speed but not the
+steering) by slowing down the inner wheel.
+"""
+import logging
+
+
+class PID(object):
+    """ Discrete PID controller, call update() once per control period """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, setpoint=0.0, output_limits=(-1.0, 1.0), derivative_tau=0.02):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.setpoint = setpoint
+        self.output_limits = output_limits
+        # time constant of the derivative low-pass in seconds, 0 disables it
+        self.derivative_tau = derivative_tau
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.output = 0.0
+        self._last_measurement = None
+
+    def _clamp(self, value):
+        low, high = self.output_limits
+        return max(low, min(high, value))
+
+    def update(self, measurement, dt):
+        """ New output for measurement, dt seconds after the previous update """
+        error = measurement - self.setpoint
+        if self._last_measurement is not None and dt > 0:
+            raw = (measurement - self._last_measurement) / dt
+            alpha = dt / (self.derivative_tau + dt)
+            self.derivative += alpha * (raw - self.derivative)
+        self._last_measurement = measurement
+
+        proportional = self.kp * error
+        derivative = self.kd * self.derivative
+        integral = self.integral + self.ki * error * dt
+        output = proportional + integral + derivative
+        clamped = self._clamp(output)
+        # only integrate while that does not push further into saturation
+        if clamped == output or (output > clamped) != (error > 0):
+            self.integral = self._clamp(integral)
+        self.output = self._clamp(proportional + self.integral + derivative)
+        return self.output
+
+
+class DifferentialSteering(object):
+    """ Steers Backwheels from a line position in [-1, 1]
+
+        A positive correction slows the left wheel, a negative one the right
+        wheel, the same way the steering table turns towards the line.
+    """
+
+    def __init__(self, backwheels, pid, speed=70):
+        self.logger = logging.getLogger(__name__)
+        self.backwheels = backwheels
+        self.pid = pid
+        self.speed = speed
+
+    def wheel_scales(self, correction):
+        if correction > 0:
+            return 1.0 - correction, 1.0
+        return 1.0, 1.0 + correction
+
+    def wheel_speeds(self, correction):
+        left_scale, right_scale = self.wheel_scales(correction)
+        return self.speed * left_scale, self.speed * right_scale
+
+    def steer(self, position, dt):
+        """ Run one control period, returns the (left, right) speeds set """
+        left_scale, right_scale = self.wheel_scales(self.pid.update(position, dt))
+        self.backwheels.steer(self.speed, left_scale, right_scale)
+        left, right = self.speed * left_scale, self.speed * right_scale
+        self.logger.debug('Position %.3f -> left %.1f right %.1f', position, left, right)
+        return left, right
+
+    def reset(self):
+        self.pid.reset()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Background line sensor sampling.
+
+LineSampler reads the line sensor at a fixed rate on its own thread and
+publishes the latest timestamped frame. Code that waits for a line
+pattern blocks on a condition variable until a matching frame arrives
+(or a timeout passes) instead of spinning on read_digital(), which
+saves a CPU core and leaves the I2C bus to the motors.
+"""
+import collections
+import logging
+import threading
+import time
+
+# code is the base-3 encoding of digital, see steering.encode(); stale
+# frames are repeated old readings, see Linefollower.read()
+LineFrame = collections.namedtuple('LineFrame', ['timestamp', 'analog', 'digital', 'sequence', 'code', 'stale'],
+                                   defaults=(False,))
+
+
+class LineSampler(object):
+    """ Reads a Linefollower at rate Hz and publishes LineFrames
+
+        Failed samples are counted and summarised in one warning per
+        log_interval seconds at most.
+    """
+
+    def __init__(self, linefollower, rate=200, log_interval=5.0):
+        self.logger = logging.getLogger(__name__)
+        self.linefollower = linefollower
+        self.rate = rate
+        self._condition = threading.Condition()
+        self._latest = None
+        self._sequence = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        self.errors = 0
+        self.log_interval = log_interval
+        self._logged_errors = 0
+        self._logged_at = float('-inf')
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='line-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_time = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                # a flaky sensor must not hold the sampler past one period
+                analog = self.linefollower.read_analog(timeout=period)
+            except IOError as e:
+                self.errors += 1
+                self._log_errors(e)
+            else:
+                self.publish(analog)
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+            else:
+                # overran a period, do not try to catch up with a burst
+                next_time = time.monotonic()
+
+    def _log_errors(self, error):
+        now = time.monotonic()
+        if now - self._logged_at < self.log_interval:
+            return
+        self.logger.warning('%d line sensor samples failed since the last report, last: %s',
+                            self.errors - self._logged_errors, error)
+        self._logged_errors = self.errors
+        self._logged_at = now
+
+    def publish(self, analog, timestamp=None):
+        """ Make analog the latest frame and wake up all waiters """
+        with self._condition:
+            self._sequence += 1
+            self._latest = self.linefollower.make_frame(analog, timestamp, self._sequence)
+            self._condition.notify_all()
+
+    def latest(self):
+        """ The most recent LineFrame, None before the first sample """
+        return self._latest
+
+    def wait_for(self, predicate, timeout=None, newer_than=0):
+        """ Block until a frame's digital status satisfies predicate
+
+            Frames with a sequence number of newer_than or less are not
+            considered. Returns the matching LineFrame, or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                frame = self._latest
+                if frame is not None and frame.sequence > newer_than:
+                    if predicate is None or predicate(frame.digital):
+                        return frame
+                    newer_than = frame.sequence
+                if self._stopped.is_set():
+                    return None
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+
+    def wait_next(self, timeout=None):
+        """ Block until a frame newer than the current latest one arrives """
+        latest = self._latest
+        return self.wait_for(None, timeout, latest.sequence if latest is not None else 0)
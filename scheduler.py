@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Fixed-rate task scheduler for the control loop.
+
+Tasks are registered with their own period and run by one thread,
+earliest release first. The scheduler sleeps until shortly before a
+release and spins for the rest, which keeps the start jitter in the tens
+of microseconds without burning a core. Every task counts how late it
+started, how long it ran, deadline misses (finished after its next
+release), overruns (ran longer than its period) and skipped releases; a
+task that falls behind skips releases instead of running in a burst.
+
+    scheduler = Scheduler()
+    scheduler.add('line', line_step, 0.005)
+    scheduler.add('obstacle', obstacle_step, 0.05)
+    scheduler.run()
+"""
+import logging
+import math
+import threading
+import time
+
+
+class Task(object):
+    """ One periodic function and its timing statistics """
+
+    def __init__(self, name, func, period, release):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.release = release
+        self.runs = 0
+        self.misses = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.late_max = 0.0
+        self.duration_max = 0.0
+        self.duration_total = 0.0
+
+    def stats(self):
+        """ Counters and timings in ms """
+        return {'period_ms': self.period * 1000,
+                'runs': self.runs,
+                'misses': self.misses,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'late_max_ms': self.late_max * 1000,
+                'duration_avg_ms': self.duration_total / self.runs * 1000 if self.runs else 0.0,
+                'duration_max_ms': self.duration_max * 1000}
+
+
+class Scheduler(object):
+    """ Runs registered tasks at their periods on the calling thread
+
+        spin is how long before a release the scheduler stops sleeping and
+        busy-waits instead.
+    """
+
+    def __init__(self, spin=0.0005, name='scheduler'):
+        self.logger = logging.getLogger(__name__)
+        self.spin = spin
+        self.name = name
+        self.tasks = []
+        self._stopped = threading.Event()
+        self.started = None
+
+    def add(self, name, func, period, offset=0.0):
+        """ Run func() every period seconds, first offset seconds after run() starts """
+        task = Task(name, func, period, offset)
+        self.tasks.append(task)
+        return task
+
+    def remove(self, name):
+        self.tasks = [task for task in self.tasks if task.name != name]
+
+    def now(self):
+        """ Seconds since run() started, the clock task releases use """
+        return time.perf_counter() - self.started
+
+    def _wait_until(self, release):
+        remaining = release - self.now()
+        if remaining > self.spin:
+            self._stopped.wait(remaining - self.spin)
+        while self.now() < release and not self._stopped.is_set():
+            pass
+
+    def run(self, duration=None):
+        """ Run the tasks until stop() or for duration seconds """
+        self._stopped.clear()
+        self.started = time.perf_counter()
+        for task in self.tasks:
+            task.release = max(task.release, 0.0)
+        while not self._stopped.is_set() and self.tasks:
+            task = min(self.tasks, key=lambda t: t.release)
+            if duration is not None and task.release >= duration:
+                break
+            self._wait_until(task.release)
+            if self._stopped.is_set():
+                break
+            self._run_task(task)
+
+    def _run_task(self, task):
+        release = task.release
+        started = self.now()
+        try:
+            task.func()
+        finally:
+            finished = self.now()
+            duration = finished - started
+            task.runs += 1
+            task.duration_total += duration
+            task.duration_max = max(task.duration_max, duration)
+            task.late_max = max(task.late_max, started - release)
+            if duration > task.period:
+                task.overruns += 1
+            task.release = release + task.period
+            if finished > task.release:
+                task.misses += 1
+                # do not catch up with a burst, carry on with the next release
+                behind = int(math.ceil((finished - task.release) / task.period))
+                task.skipped += behind
+                task.release += behind * task.period
+                self.logger.debug('%s missed its deadline by %.1f ms',
+                                  task.name, (finished - release - task.period) * 1000)
+
+    def stop(self):
+        """ Make run() return after the running task, callable from any thread """
+        self._stopped.set()
+
+    def stats(self):
+        return dict((task.name, task.stats()) for task in self.tasks)
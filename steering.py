@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Table driven steering for the line follower.
+
+Every digital sensor frame is encoded as a base-3 number (see
+Linefollower.encode), so all 3**5 = 243 possible frames, including the
+"exactly on the reference" state, index one precomputed table entry that
+says what to do with the wheels. Tables can be generated from speed
+settings, printed, patched entry by entry and swapped while running.
+"""
+import collections
+
+CODE_SIZE = 3 ** 5
+
+# digit values of a sensor in the code: white, black, equal to reference
+WHITE, BLACK, EQUAL = 0, 1, 2
+
+# last_forward_direction values of the line follower
+STRAIGHT, LEFT, RIGHT = 0, 1, 2
+
+Steer = collections.namedtuple('Steer', ['left', 'right', 'direction', 'off_track'])
+# no wheel change and no direction memory update; the old chain's "else"
+KEEP = Steer(None, None, None, False)
+OFF_TRACK = Steer(None, None, None, True)
+
+
+def encode(digital):
+    """ Base-3 code of a read_digital() list, leftmost sensor most significant """
+    code = 0
+    for value in digital:
+        code = code * 3 + (EQUAL if value == -1 else value)
+    return code
+
+
+def decode(code):
+    """ The read_digital() list for a code """
+    digital = []
+    for _ in range(5):
+        code, digit = divmod(code, 3)
+        digital.insert(0, -1 if digit == EQUAL else digit)
+    return digital
+
+
+def _resolve(digital, equal_as):
+    return tuple(equal_as if value == -1 else value for value in digital)
+
+
+class SteeringTable(object):
+    """ code -> Steer lookup """
+
+    def __init__(self, entries):
+        entries = list(entries)
+        if len(entries) != CODE_SIZE:
+            raise ValueError('A steering table needs %d entries, not %d' % (CODE_SIZE, len(entries)))
+        self.entries = entries
+
+    def __getitem__(self, code):
+        return self.entries[code]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, digital, steer):
+        """ Replace the entry of one digital pattern """
+        self.entries[encode(digital)] = steer
+
+    @classmethod
+    def generate(cls, base_speed=30, left_speed=30, right_speed=30,
+                 steps=(0.9, 0.7, 0.5), equal_as=BLACK):
+        """ Table of the line follower's classic pattern rules
+
+            steps are the inner wheel factors for the line one, two and
+            three or more sensors off centre. Sensors exactly on their
+            reference (-1) are treated as equal_as.
+        """
+        a_step, b_step, c_step = steps
+        rules = {
+            (0, 0, 1, 0, 0): Steer(base_speed, base_speed, STRAIGHT, False),
+            # line right of centre: slow down the right wheel's partner
+            (0, 0, 1, 1, 0): Steer(int(left_speed * a_step), int(right_speed), RIGHT, False),
+            (0, 0, 0, 1, 0): Steer(int(left_speed * b_step), int(right_speed), RIGHT, False),
+            (0, 0, 0, 1, 1): Steer(int(left_speed * c_step), int(right_speed), RIGHT, False),
+            (0, 0, 0, 0, 1): Steer(int(left_speed * c_step), int(right_speed), RIGHT, False),
+            (0, 0, 1, 1, 1): Steer(int(right_speed), int(right_speed), RIGHT, False),
+            (0, 1, 1, 1, 1): Steer(int(right_speed), int(right_speed), RIGHT, False),
+            # line left of centre
+            (0, 1, 1, 0, 0): Steer(int(left_speed), int(right_speed * a_step), LEFT, False),
+            (0, 1, 0, 0, 0): Steer(int(left_speed), int(right_speed * b_step), LEFT, False),
+            (1, 1, 0, 0, 0): Steer(int(left_speed), int(right_speed * c_step), LEFT, False),
+            (1, 0, 0, 0, 0): Steer(int(left_speed), int(right_speed * c_step), LEFT, False),
+            (1, 1, 1, 0, 0): Steer(int(left_speed), int(left_speed), LEFT, False),
+            (1, 1, 1, 1, 0): Steer(int(left_speed), int(left_speed), LEFT, False),
+            (0, 0, 0, 0, 0): OFF_TRACK,
+        }
+        return cls(rules.get(_resolve(decode(code), equal_as), KEEP) for code in range(CODE_SIZE))
+
+    def describe(self, skip_keep=True):
+        """ One line per entry: pattern, wheel speeds, direction memory """
+        names = {STRAIGHT: 'straight', LEFT: 'left', RIGHT: 'right', None: '-'}
+        lines = []
+        for code, steer in enumerate(self.entries):
+            if skip_keep and steer == KEEP:
+                continue
+            pattern = ''.join('=' if value == -1 else str(value) for value in decode(code))
+            if steer.off_track:
+                action = 'off track'
+            elif steer.left is None:
+                action = 'keep'
+            else:
+                action = 'left %3s right %3s  %s' % (steer.left, steer.right, names[steer.direction])
+            lines.append('%3d %s  %s' % (code, pattern, action))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(SteeringTable.generate().describe())
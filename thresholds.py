@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Online line sensor thresholds.
+
+ReferenceTracker follows the white and black readings of each of the
+five line sensors with an online 2-means: every analog value joins the
+nearer of its sensor's two clusters and updates that cluster's running
+mean and variance (Welford, turning into an exponential average once a
+cluster holds `window` samples). Until both clusters hold `min_samples`
+values are split at the current reference instead, so one early outlier
+can not become a cluster mean that later frames are split against. The
+reference sits between the two means, shifted towards the tighter
+cluster, and is only republished when it moved by at least `hysteresis`
+counts, so the digital status does not flicker while the thresholds
+follow lighting and surface changes.
+"""
+import logging
+
+
+class _Cluster(object):
+    """ Running mean and variance of one white or black cluster """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def add(self, value, window):
+        if self.count < window:
+            self.count += 1
+        weight = 1.0 / self.count
+        delta = value - self.mean
+        self.mean += weight * delta
+        self.variance = (1.0 - weight) * (self.variance + weight * delta * delta)
+
+    def seed(self, mean, count=1):
+        self.count = count
+        self.mean = float(mean)
+        self.variance = 0.0
+
+
+class ReferenceTracker(object):
+    """ Adapts line sensor references from a stream of analog frames """
+
+    def __init__(self, references, window=500, hysteresis=4, min_contrast=20, min_samples=20):
+        self.logger = logging.getLogger(__name__)
+        self.references = list(references)
+        self.window = window
+        self.hysteresis = hysteresis
+        self.min_contrast = min_contrast
+        self.min_samples = min_samples
+        self.white = [_Cluster() for _ in self.references]
+        self.black = [_Cluster() for _ in self.references]
+        self.frames = 0
+        self.updates = 0
+
+    def seed(self, white_references, black_references):
+        """ Start the clusters from a white/black calibration """
+        for white, black, white_value, black_value in zip(self.white, self.black,
+                                                          white_references, black_references):
+            white.seed(white_value, self.min_samples)
+            black.seed(black_value, self.min_samples)
+
+    def _distinct(self, white, black):
+        """ True once both clusters are well sampled and far enough apart """
+        if white.count < self.min_samples or black.count < self.min_samples:
+            return False
+        return white.mean - black.mean >= self.min_contrast
+
+    def means(self, i):
+        """ (white, black) mean of sensor i, None while they are not distinct """
+        white = self.white[i]
+        black = self.black[i]
+        if not self._distinct(white, black):
+            return None
+        return white.mean, black.mean
+
+    def _threshold(self, white, black):
+        """ Reference between both means, or None while they are not distinct """
+        if not self._distinct(white, black):
+            return None
+        white_sd = white.variance ** 0.5
+        black_sd = black.variance ** 0.5
+        if white_sd + black_sd == 0:
+            return (white.mean + black.mean) / 2
+        # equally many standard deviations away from both clusters
+        return (white.mean * black_sd + black.mean * white_sd) / (white_sd + black_sd)
+
+    def update(self, analog):
+        """ Feed one analog frame, returns new references or None if unchanged """
+        self.frames += 1
+        changed = False
+        references = self.references
+        for i, value in enumerate(analog):
+            white = self.white[i]
+            black = self.black[i]
+            if white.count >= self.min_samples and black.count >= self.min_samples:
+                is_white = abs(value - white.mean) <= abs(value - black.mean)
+            else:
+                # no two established clusters yet, split at the current reference
+                is_white = value > references[i]
+            (white if is_white else black).add(value, self.window)
+
+            threshold = self._threshold(white, black)
+            if threshold is not None and abs(threshold - references[i]) >= self.hysteresis:
+                if not changed:
+                    references = list(references)
+                    changed = True
+                references[i] = int(round(threshold))
+        if not changed:
+            return None
+        self.references = references
+        self.updates += 1
+        self.logger.debug('References adapted to %s', references)
+        return references
+
+    def stats(self):
+        """ Per sensor white/black means and standard deviations """
+        return {'frames': self.frames,
+                'updates': self.updates,
+                'references': list(self.references),
+                'white': [(round(c.mean, 1), round(c.variance ** 0.5, 1)) for c in self.white],
+                'black': [(round(c.mean, 1), round(c.variance ** 0.5, 1)) for c in self.black]}
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Control loop watchdog.
+
+The control loop has to feed() the watchdog before its deadline. If it
+stalls instead (blocking sensor wait, runaway busy loop ...) the watchdog
+thread calls the expire action, normally Backwheels.emergency_stop, and
+records how long the loop was stalled once it is fed again.
+"""
+import logging
+import threading
+import time
+
+
+class Watchdog(object):
+    """ Calls on_expire when feed() is not called within timeout seconds """
+
+    def __init__(self, timeout, on_expire, name='watchdog'):
+        self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.name = name
+        self._lock = threading.Lock()
+        self._fed = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_feed = time.monotonic()
+        self._deadline = self._last_feed + timeout
+        self.tripped = False
+        self.trips = 0
+        self.last_stall = 0.0
+        self.max_stall = 0.0
+        self.last_stop_latency = 0.0
+
+    def start(self):
+        """ Start watching, the first deadline is timeout seconds from now """
+        if self._thread is not None:
+            return
+        self.feed()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop watching """
+        self._stopped.set()
+        self._fed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def feed(self, grace=None):
+        """ Push the deadline out by timeout, or by grace seconds for a known long step """
+        now = time.monotonic()
+        with self._lock:
+            if self.tripped:
+                self.last_stall = now - self._last_feed
+                self.max_stall = max(self.max_stall, self.last_stall)
+                self.tripped = False
+                self.logger.warning('%s: loop stalled for %.3f s' % (self.name, self.last_stall))
+            self._last_feed = now
+            self._deadline = now + (self.timeout if grace is None else grace)
+        self._fed.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # clear before looking at the state, a feed() from here on sets
+            # the event again and the wait below returns right away
+            self._fed.clear()
+            with self._lock:
+                remaining = self._deadline - time.monotonic()
+                tripped = self.tripped
+            if remaining > 0 or tripped:
+                self._fed.wait(remaining if remaining > 0 else None)
+                continue
+            with self._lock:
+                self.tripped = True
+                self.trips += 1
+            self.logger.error('%s: not fed for %.3f s, stopping' % (self.name, time.monotonic() - self._last_feed))
+            start = time.perf_counter()
+            try:
+                self.on_expire()
+            except Exception:
+                self.logger.exception('%s: expire action failed' % self.name)
+            self.last_stop_latency = time.perf_counter() - start
+
+    def stats(self):
+        """ Trip count, stall durations and the time the last stop action took (s) """
+        return {'trips': self.trips, 'tripped': self.tripped, 'last_stall': self.last_stall,
+                'max_stall': self.max_stall, 'last_stop_latency': self.last_stop_latency}